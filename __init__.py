@@ -17,18 +17,53 @@
 # Usage:
 # * wiki syntax: "[:pc:/// .....code..... :::options1=val1;options2=val2;...///]"
 # * options:
-#      * lang: the name of the programming language (see the plugin options panel for a list of these) (default: see the plugin options panel)
+#      * lang: the name of the programming language (see the plugin options panel for a list of these),
+#           "auto" to detect it from the code (default: see the plugin options panel)
 #      * showLines: 0 if the line numbers should not be displayed, a non-zero value otherwise (default: see the plugin options panel)
 #      * startLine: the number of the first line  (default: 1)
 #      * hlLines: a comma separated list of line numbers to highlight (default: none)
 #      * bkg: the Id of a background defined in the options panel, 
 #           "default" for the default background (or no bkg option), 
 #            an empty string for no background
+#      * maxSize: the maximal size (in characters) of a highlighted block, larger blocks are shown as plain text (default: see the plugin options panel)
+#      * maxLines: the maximal number of lines of a highlighted block (default: see the plugin options panel)
+#      * timeLimit: the time (in ms) after which the highlighting is abandoned for plain text, 0 for no limit (default: see the plugin options panel)
+#      * file: the name of a file of the "PrettyCodeFiles" folder of the wiki data directory holding the code,
+#           the code of the insertion is ignored then (large pastes can be stored so)
 #  * menu entries:
 #      * paste the clipboard contents as a code with the default options set in the plugin options panel
 #      * surround the selection with the appropriate tags, option values are the default options set in the plugin options panel
 #
 # ChangeLog:
+#  * 18 Oct. 2026:
+#     * LRU cache of the rendered insertions
+#     * per export task state, the insertions of the exported pages are rendered in batches
+#     * optional process pool to highlight the large blocks of the exports in parallel
+#     * the lexers and the formatters are pooled instead of created for each insertion
+#     * the internal previewer markup is produced by a formatter instead of re-parsing the HTML
+#     * the options are parsed once (without eval) until they are saved
+#     * compiled and memoized parser of the insertion options, errors report their column
+#     * the language list is built once and kept on disk, languages can also be given by name
+#     * Pygments is loaded on demand or in the background after startup, timing report
+#     * the preview re-lexes large blocks from the first edited line until the lexer state re-synchronizes
+#     * the blocks are streamed from the lexer through the formatter to the output (writeContent, timeLimit=0)
+#     * size, line and time limits, the blocks over the limits are shown as plain text
+#     * optional background highlighting of the large preview blocks, plain text is shown meanwhile
+#     * benchmark.py: headless benchmark of the rendering of a corpus of blocks, JSON results
+#     * optional statistics of the rendering stages, counters and slowest blocks, dumped as JSON at task end
+#     * the exported pages use CSS classes and a style sheet written once per page instead of inline styles
+#       (inline styles when the exporter does not give the exported page)
+#     * the duplicate blocks of an export task are rendered once, the task end report counts them
+#     * optional SQLite cache of the rendered insertions in the wiki data directory, shared by the sessions
+#     * lang=auto detects the language from the shebang, the first line and a keyword index
+#     * optional highlighting of the blocks of the opened pages in the background, before the preview asks for them
+#     * the token streams of the large blocks are kept in a compact form, a change of their line options does not lex them again
+#     * the render cache has a memory budget, the large blocks are kept compressed
+#     * large pastes are inserted in chunks with a progress dialog, or stored in a file (file option)
+#     * SQLite index of the code blocks of the wiki, updated when the pages are saved, report of the languages,
+#       largest and slowest blocks, which can be highlighted ahead
+#     * compact HTML option: the adjacent tokens of the same style share a span, no span around the
+#       whitespace, shortest inline styles
 #  * 24 Mar. 2013 (Michael Butscher):
 #     * Packed into ZIP file including pygments (modified to use relative imports only)
 #     * Support for setting options in the appendices of the insertion
@@ -44,13 +79,17 @@
 #  * 26 Oct. 2008: first release
 #
 ######################################################################################
-import os, sys, glob, cStringIO, wx
+import os, sys, re, ast, glob, time, json, zlib, heapq, itertools, hashlib, threading, cPickle, wx
+from collections import OrderedDict, namedtuple
+from array import array
+_loadStart = time.time()
 
 # The APIs we expose
 WIKIDPAD_PLUGIN = (
     ("MenuFunctions",1),
     ("InsertionByKey", 1), 
     ("Options", 1),
+    ("hooks", 1),
     )
 
 INSERTION_TAG = u"pc"
@@ -71,11 +110,225 @@ OPTION_BKG = "plugin_prettyCode_Bkg"
 BKG_TMPL = u'background-color: #F7F9FA; border: 1px #8CACBB dashed; width: 80%; padding: 4px; margin: 2'
 BKG_NEW = _(u"Bkg %d")
 NO_BKG = _(u"None")
+DEFAULT_CACHESIZE = 200
+OPTION_CACHESIZE = "plugin_prettyCode_CacheSize"
+DEFAULT_CACHEMEMORY = 32
+OPTION_CACHEMEMORY = "plugin_prettyCode_CacheMemory"
+CACHE_COMPRESS_MIN_SIZE = 4096
+DEFAULT_CACHEPERSIST = False
+OPTION_CACHEPERSIST = "plugin_prettyCode_CachePersist"
+DEFAULT_DISKCACHESIZE = 64
+OPTION_DISKCACHESIZE = "plugin_prettyCode_DiskCacheSize"
+CACHE_FILENAME = "PrettyCode.cache.db"
+CACHE_VERSION = 2
+CACHE_FLUSH_INTERVAL = 10
+DEFAULT_PARALLEL = False
+OPTION_PARALLEL = "plugin_prettyCode_Parallel"
+DEFAULT_PARALLELMINSIZE = 4096
+OPTION_PARALLELMINSIZE = "plugin_prettyCode_ParallelMinSize"
+PARALLEL_TIMEOUT = 300
+PARALLEL_PROBE_TIMEOUT = 15
+DEFAULT_WARMUP = True
+OPTION_WARMUP = "plugin_prettyCode_WarmUp"
+WARMUP_DELAY = 5000
+DEFAULT_INCREMENTAL = True
+OPTION_INCREMENTAL = "plugin_prettyCode_Incremental"
+INCREMENTAL_MIN_LINES = 200
+INCREMENTAL_HISTORY = 8
+TOKEN_CACHE_SIZE = 8 << 20
+TOKEN_CACHE_MIN_SIZE = 2000
+# the blocks written with InsertionHandler.writeContent() from this size are
+# streamed to the output, without a time limit only (see ExportTask.writeBlock)
+STREAM_MIN_SIZE = 1 << 20
+DEFAULT_MAXSIZE = 2000000
+OPTION_MAXSIZE = "plugin_prettyCode_MaxSize"
+DEFAULT_MAXLINES = 50000
+OPTION_MAXLINES = "plugin_prettyCode_MaxLines"
+DEFAULT_TIMELIMIT = 5000
+OPTION_TIMELIMIT = "plugin_prettyCode_TimeLimit"
+DEFAULT_ASYNC = False
+OPTION_ASYNC = "plugin_prettyCode_Async"
+ASYNC_MIN_SIZE = 20000
+DEFAULT_CODEINDEX = False
+OPTION_CODEINDEX = "plugin_prettyCode_CodeIndex"
+CODE_FILES_DIRNAME = "PrettyCodeFiles"
+LARGE_PASTE_SIZE = 1 << 20
+PASTE_CHUNK_SIZE = 256 << 10
+DEFAULT_PREFETCH = False
+OPTION_PREFETCH = "plugin_prettyCode_Prefetch"
+DEFAULT_STATS = False
+OPTION_STATS = "plugin_prettyCode_Stats"
+DEFAULT_STATSFILE = u""
+OPTION_STATSFILE = "plugin_prettyCode_StatsFile"
+DEFAULT_CSSCLASSES = True
+OPTION_CSSCLASSES = "plugin_prettyCode_CssClasses"
+DEFAULT_COMPACTHTML = False
+OPTION_COMPACTHTML = "plugin_prettyCode_CompactHtml"
 
 #####
 # TODO: show and format exception report
 #####
 
+def escapeHtml(text):
+    """
+    Escape the HTML special characters of a text
+    """
+    return text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+
+######################################################################################
+# Timings
+######################################################################################
+# time spent by the plugin in its startup steps and first rendering: name -> seconds
+timings = {}
+
+def recordTiming(name, start):
+    """
+    Record the time spent in a step since start, only the first occurrence is kept
+    """
+    timings.setdefault(name, time.time() - start)
+
+def getTimingReport():
+    """
+    Return the time (in seconds) added by the plugin to the startup of
+    WikidPad ("startup") and to the first rendering ("first render"),
+    with the details of the steps
+    """
+    report = dict(timings)
+    report["startup"] = timings.get("module load", 0.0) + timings.get("registration", 0.0)
+    return report
+
+######################################################################################
+# Statistics
+######################################################################################
+class RenderStatistics(object):
+    """
+    Time spent in the rendering stages, counters and slowest blocks,
+    collected only when the stats option is set
+    """
+    # the stages: parsing the insertion options, getting the lexer and the
+    # formatter, lexing, formatting (with the markup of the internal
+    # previewer), adding the background, highlighting in the process pool
+    STAGES = ("options", "lexer", "tokenize", "format", "background", "pool")
+    COUNTERS = ("tasks", "blocks", "bytes", "cacheHits", "cacheMisses", "diskHits", "errors", "plain",
+        "duplicates", "duplicateBytes")
+    # number of slowest blocks kept
+    SLOWEST = 10
+    def __init__(self):
+        """
+        Constructor
+        """
+        # the blocks of the preview may be rendered in the background
+        self.lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        """
+        Clear the statistics
+        """
+        with self.lock:
+            self.stages = dict.fromkeys(self.STAGES, 0.0)
+            self.counters = dict.fromkeys(self.COUNTERS, 0)
+            self.languages = {}
+            self.exportTypes = {}
+            # heap of (seconds, page, lang, size)
+            self.slowest = []
+    def addTime(self, stage, seconds):
+        """
+        Add the time spent in a stage
+        """
+        with self.lock:
+            self.stages[stage] += seconds
+    def count(self, name, n=1):
+        """
+        Increment a counter
+        """
+        with self.lock:
+            self.counters[name] += n
+    def addBlock(self, seconds, size, lang, exportType, page):
+        """
+        Count a rendered block
+        @param seconds: the time spent to render the block
+        @param size: the size of the code
+        @param page: the name of the wiki page or None if unknown
+        """
+        lang = lang.lower()
+        with self.lock:
+            self.counters["blocks"] += 1
+            self.counters["bytes"] += size
+            self.languages[lang] = self.languages.get(lang, 0) + 1
+            self.exportTypes[exportType] = self.exportTypes.get(exportType, 0) + 1
+            entry = (seconds, page, lang, size)
+            if len(self.slowest) < self.SLOWEST:
+                heapq.heappush(self.slowest, entry)
+            elif entry > self.slowest[0]:
+                heapq.heapreplace(self.slowest, entry)
+    def getStats(self):
+        """
+        Return the statistics as a dictionary
+        """
+        with self.lock:
+            return {
+                "stages": dict(self.stages),
+                "counters": dict(self.counters),
+                "languages": dict(self.languages),
+                "exportTypes": dict(self.exportTypes),
+                "slowest": [{"seconds": seconds, "page": page, "lang": lang, "size": size}
+                    for seconds, page, lang, size in sorted(self.slowest, reverse=True)],
+                }
+    def dump(self, path):
+        """
+        Append the statistics as a line of JSON to a file
+        """
+        stats = self.getStats()
+        stats["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            with open(path, "a") as f:
+                f.write(json.dumps(stats, sort_keys=True) + "\n")
+        except (IOError, OSError):
+            pass
+
+class TokenTimer(object):
+    """
+    Measure the time spent in the lexer while the formatter consumes its tokens
+    """
+    def __init__(self, elapsed=0.0):
+        """
+        Constructor
+        @param elapsed: the time already spent in lexing
+        """
+        self.elapsed = elapsed
+    def wrap(self, tokens):
+        """
+        Yield the tokens, adding the time spent to get them to elapsed
+        """
+        clock = time.time
+        tokens = iter(tokens)
+        while True:
+            start = clock()
+            try:
+                token = tokens.next()
+            except StopIteration:
+                self.elapsed += clock() - start
+                return
+            self.elapsed += clock() - start
+            yield token
+
+renderStatistics = RenderStatistics()
+
+def getRenderStatistics():
+    """
+    Return the statistics collected since startup or the last reset,
+    see RenderStatistics.getStats()
+    """
+    return renderStatistics.getStats()
+
+def getStatsPath(app, options):
+    """
+    Return the path of the file the statistics are dumped to or None
+    """
+    if not options.statsFile:
+        return None
+    return os.path.join(app.getGlobalConfigSubDir(), os.path.expanduser(options.statsFile))
+
 ######################################################################################
 # Pygments
 ######################################################################################
@@ -87,16 +340,309 @@ def import_Pygments(app):
     Load the Pygments library
     """
     global pygments
-    from . import pygments
+    if pygments is None:
+        start = time.time()
+        from . import pygments
+        recordTiming("pygments import", start)
+
+LANGUAGES_FILENAME = "PrettyCode.languages"
+
+class LanguageCatalogue(object):
+    """
+    The languages known by Pygments
+    """
+    def __init__(self, names, aliases):
+        """
+        Constructor
+        @param names: the sorted language names
+        @param aliases: lexer alias by lower case language name or alias
+        """
+        self.names = names
+        self.aliases = aliases
+    @staticmethod
+    def build():
+        """
+        Build the catalogue from the lexers of Pygments
+        """
+        from .pygments.lexers import get_all_lexers #@UnresolvedImport
+        names = []
+        aliases = {}
+        lexerNames = []
+        for name, lexerAliases, filenames, mimetypes in get_all_lexers(): #@UnusedVariable
+            if not lexerAliases:
+                # the lexer cannot be retrieved by name
+                continue
+            if not isinstance(name, unicode):
+                name = unicode(name, "utf-8", "ignore")
+            names.append(name)
+            for alias in lexerAliases:
+                aliases.setdefault(unicode(alias).lower(), lexerAliases[0])
+            lexerNames.append((name.lower(), lexerAliases[0]))
+        # the aliases have priority over the names
+        for name, alias in lexerNames:
+            aliases.setdefault(name, alias)
+        names.sort()
+        return LanguageCatalogue(names, aliases)
+    @staticmethod
+    def load(path, version):
+        """
+        Load the catalogue saved by save() for the given Pygments version
+        Return None if there is none
+        """
+        try:
+            f = open(path, "rb")
+            try:
+                savedVersion, names, aliases = cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError, cPickle.UnpicklingError):
+            return None
+        if savedVersion != version:
+            return None
+        return LanguageCatalogue(names, aliases)
+    def save(self, path, version):
+        """
+        Save the catalogue for the given Pygments version
+        """
+        try:
+            f = open(path, "wb")
+            try:
+                cPickle.dump((version, self.names, self.aliases), f, cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+        except (IOError, OSError):
+            pass
+    def resolve(self, lang):
+        """
+        Return the lexer alias of a language name or alias, None if it is unknown
+        """
+        if not isinstance(lang, unicode):
+            lang = unicode(lang, "utf-8", "ignore")
+        return self.aliases.get(lang.strip().lower())
+
+# the catalogue, built at first use
+languageCatalogue = None
+
+def getLanguageCatalogue(app=None):
+    """
+    Return the language catalogue, build it (or load it from the disk) at first call
+    @param app: the application, None to not use the catalogue on disk
+    """
+    global languageCatalogue
+    if languageCatalogue is None:
+        start = time.time()
+        import_Pygments(app)
+        path = None
+        getSubDir = getattr(app, "getGlobalConfigSubDir", None)
+        if getSubDir is not None:
+            path = os.path.join(getSubDir(), LANGUAGES_FILENAME)
+        version = getattr(pygments, "__version__", None)
+        catalogue = None
+        if path:
+            catalogue = LanguageCatalogue.load(path, version)
+        if catalogue is None:
+            catalogue = LanguageCatalogue.build()
+            if path:
+                catalogue.save(path, version)
+        languageCatalogue = catalogue
+        recordTiming("language catalogue", start)
+    return languageCatalogue
+
+######################################################################################
+# Language detection
+######################################################################################
+# the language of the blocks to detect from their content
+AUTO_LANG = u"auto"
+# number of characters of a block looked at by the detection
+DETECT_SAMPLE_SIZE = 4096
+# time budget (in seconds) of the calls to analyse_text() of a detection
+DETECT_TIME_LIMIT = 0.05
+# number of best candidates of the keyword index checked by their lexer
+DETECT_CANDIDATES = 3
+# minimal keyword score of a candidate
+DETECT_MIN_SCORE = 2
+# number of detected languages kept
+DETECT_MEMO_SIZE = 4096
+
+SHEBANG_RE = re.compile(r"#!\s*(?:\S*/)?(?:env\s+(?:-\S+\s+)*)?([A-Za-z]+)")
+# interpreter of a shebang line -> language
+SHEBANG_LANGUAGES = {
+    "python": "python", "perl": "perl", "ruby": "ruby", "php": "php", "lua": "lua",
+    "sh": "bash", "bash": "bash", "zsh": "bash", "ksh": "bash",
+    "node": "js", "nodejs": "js", "tclsh": "tcl", "awk": "awk", "gawk": "awk",
+    }
+# patterns of the start of a block -> language
+START_LANGUAGES = (
+    (re.compile(r"\s*<\?xml\b"), "xml"),
+    (re.compile(r"\s*(?:<!DOCTYPE\s+html|<html\b)", re.I), "html"),
+    (re.compile(r"\s*<\?php\b"), "php"),
+    (re.compile(r"(?:diff -|Index: |--- \S.*\n\+\+\+ )"), "diff"),
+    )
+# keyword index: language -> patterns, a block scores the number of
+# matches of each pattern (at most DETECT_MAX_MATCHES)
+KEYWORD_PATTERNS = {
+    "python": (r"^\s*def \w+\(.*\):\s*$", r"^\s*(?:from [\w.]+ )?import \w", r"\bself\.",
+        r"^\s*elif\b", r"\bNone\b", r"^\s*class \w+(?:\(.*\))?:\s*$", r'"""'),
+    "c": (r"^#include\s*<\w+\.h>", r"\bprintf\s*\(", r"\bmalloc\s*\(", r"\bstruct\s+\w+\s*\{",
+        r"->", r"\bint\s+main\s*\("),
+    "cpp": (r"^#include\s*<\w+>", r"\bstd::", r"\btemplate\s*<", r"\bnamespace\b", r"\bcout\b",
+        r"\bclass\s+\w+\s*(?::\s*public\b|\{)", r"\w::\w"),
+    "java": (r"^\s*import java\.", r"\bpublic\s+(?:static\s+)?(?:class|void|final)\b",
+        r"\bSystem\.out\.", r"\bString\[\]", r"@Override", r"\bnew\s+\w+<"),
+    "csharp": (r"^\s*using System", r"\bnamespace\s+[\w.]+", r"\bConsole\.Write",
+        r"\bpublic\s+(?:override|virtual)\b", r"\{\s*get;"),
+    "js": (r"\bfunction\s*\w*\s*\(", r"\bvar\s+\w+\s*=", r"\b(?:let|const)\s+\w+\s*=", r"=>",
+        r"\bconsole\.log\b", r"\bdocument\.", r"==="),
+    "ruby": (r"^\s*end\s*$", r"^\s*def \w+[?!]?(?:\(.*\))?\s*$", r"\bputs\b", r"\battr_\w+",
+        r"\bdo\s*\|", r"^\s*require\s+['\"]"),
+    "perl": (r"\bmy\s+[\$@%]", r"^\s*use\s+(?:strict|warnings)", r"=~", r"\$_\b", r"^\s*sub\s+\w+",
+        r"\bforeach\b"),
+    "bash": (r"^\s*(?:if|while)\s+\[", r"^\s*fi\s*$", r"^\s*done\s*$", r"\becho\b", r"\$\(",
+        r"^\s*(?:export|local)\s+\w+="),
+    "sql": (r"(?i)\bselect\b.*\bfrom\b", r"(?i)\bwhere\b", r"(?i)\binsert\s+into\b",
+        r"(?i)\bcreate\s+table\b", r"(?i)\bjoin\b", r"(?i)\bgroup\s+by\b"),
+    "css": (r"^\s*[\w.#:\-\s,>]+\{\s*$", r"^\s*[\w\-]+\s*:\s*[^;{]+;\s*$", r"#[0-9a-fA-F]{3,6}\b",
+        r"\d(?:px|em)\b"),
+    "php": (r"<\?php", r"\$this->", r"\$\w+\s*=", r"\bfunction\s+\w+\s*\("),
+    "html": (r"<(?:div|span|p|a|table|td|tr|body|head|script)\b", r"</\w+>", r"&\w+;"),
+    "xml": (r"<\w+:\w+", r"</\w+>", r"/>"),
+    "ini": (r"^\s*\[[\w .\-]+\]\s*$", r"^\s*[\w.\-]+\s*=", r"^\s*;"),
+    "diff": (r"^@@ .* @@", r"^(?:\+\+\+|---) \S"),
+    "make": (r"^[\w.\-/]+\s*:(?!=)", r"^\t", r"\$\(\w+\)", r"^\w+\s*[:?+]?="),
+    "lua": (r"\blocal\s+\w+", r"\bfunction\b", r"~=", r"\bthen\b"),
+    "go": (r"^package\s+\w+", r"\bfunc\s+", r":=", r"\bfmt\.", r"^import\s+\("),
+    }
+DETECT_MAX_MATCHES = 5
+# the compiled keyword index, built at first use
+keywordIndex = None
+# code digest -> detected lexer alias or None
+detectedLanguages = OrderedDict()
+
+def getKeywordIndex():
+    """
+    Return the keyword index as a list of (lexer alias, compiled patterns)
+    of the languages known by Pygments
+    """
+    global keywordIndex
+    if keywordIndex is None:
+        catalogue = getLanguageCatalogue()
+        index = []
+        for lang, patterns in sorted(KEYWORD_PATTERNS.items()):
+            alias = catalogue.resolve(lang)
+            if alias is not None:
+                index.append((alias, [re.compile(x, re.M) for x in patterns]))
+        keywordIndex = index
+    return keywordIndex
+
+def detectLanguage(code, app=None):
+    """
+    Return the lexer alias of the language of a block or None if unknown
+    The candidates are found with the shebang, the start of the block and
+    the keyword index, the best ones are checked with the analyse_text()
+    of their lexer within DETECT_TIME_LIMIT
+    The results are memoized by content
+    """
+    digest = hashlib.sha1(code.encode("utf-8", "replace")).digest()
+    try:
+        alias = detectedLanguages.pop(digest)
+    except KeyError:
+        alias = _detectLanguage(code[:DETECT_SAMPLE_SIZE].lstrip(u"\r\n"), app)
+    detectedLanguages[digest] = alias
+    while len(detectedLanguages) > DETECT_MEMO_SIZE:
+        detectedLanguages.popitem(last=False)
+    return alias
+
+def _detectLanguage(sample, app):
+    catalogue = getLanguageCatalogue(app)
+    match = SHEBANG_RE.match(sample)
+    if match:
+        lang = SHEBANG_LANGUAGES.get(match.group(1).rstrip("0123456789").lower())
+        alias = lang and catalogue.resolve(lang)
+        if alias is not None:
+            return alias
+    for regex, lang in START_LANGUAGES:
+        if regex.match(sample):
+            alias = catalogue.resolve(lang)
+            if alias is not None:
+                return alias
+    scores = []
+    for alias, patterns in getKeywordIndex():
+        score = 0
+        for pattern in patterns:
+            score += min(DETECT_MAX_MATCHES, len(pattern.findall(sample)))
+        if score >= DETECT_MIN_SCORE:
+            scores.append((score, alias))
+    if not scores:
+        return None
+    scores.sort(reverse=True)
+    best = scores[0][1]
+    bestScore = 0.0
+    # the lexers are built out of the time limit (warmUp pools them)
+    candidates = []
+    for score, alias in scores[:DETECT_CANDIDATES]:
+        try:
+            candidates.append((score, alias, getLexer(alias, app)))
+        except Exception:
+            candidates.append((score, alias, None))
+    deadline = time.time() + DETECT_TIME_LIMIT
+    for score, alias, lexer in candidates:
+        if time.time() > deadline:
+            break
+        try:
+            rating = float(lexer.analyse_text(sample) or 0.0)
+        except Exception:
+            rating = 0.0
+        # analyse_text() rates between 0 and 1, it only raises a keyword score
+        if score * (1.0 + rating) > bestScore:
+            best, bestScore = alias, score * (1.0 + rating)
+    return best
 
 ######################################################################################
 # Options
 ######################################################################################
+# incremented each time the plugin options are saved, see Options.get()
+optionsGeneration = 0
+# the parsed options of each configuration: config -> (generation, options)
+optionsSnapshots = {}
+
+def parseBkgs(text):
+    """
+    Parse the backgrounds option, a dictionary literal: Id -> style
+    Return the default backgrounds if the value is not valid
+    """
+    try:
+        bkgs = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return dict(DEFAULT_BKGS)
+    if not isinstance(bkgs, dict):
+        return dict(DEFAULT_BKGS)
+    return bkgs
+
+def invalidateOptions():
+    """
+    Force the options to be parsed again by the next call to Options.get()
+    """
+    global optionsGeneration
+    optionsGeneration += 1
+
 class Options(object):
     """
     The plugin options
     """
     @staticmethod
+    def get(config):
+        """
+        Return the options of a configuration
+        The options are parsed once and shared until they are saved, the
+        returned object must not be modified
+        """
+        snapshot = optionsSnapshots.get(config)
+        if snapshot is not None and snapshot[0] == optionsGeneration:
+            return snapshot[1]
+        options = Options(config)
+        optionsSnapshots[config] = (optionsGeneration, options)
+        return options
+    @staticmethod
     def register(app):
         """
         Register the plugin options
@@ -105,6 +651,24 @@ class Options(object):
         app.getDefaultGlobalConfigDict()[("main", OPTION_SHOWLN)] = unicode(DEFAULT_SHOWLN)
         app.getDefaultGlobalConfigDict()[("main", OPTION_BKGS)] = unicode(DEFAULT_BKGS)
         app.getDefaultGlobalConfigDict()[("main", OPTION_BKG)] = DEFAULT_BKG
+        app.getDefaultGlobalConfigDict()[("main", OPTION_CACHESIZE)] = unicode(DEFAULT_CACHESIZE)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_CACHEMEMORY)] = unicode(DEFAULT_CACHEMEMORY)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_CACHEPERSIST)] = unicode(DEFAULT_CACHEPERSIST)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_DISKCACHESIZE)] = unicode(DEFAULT_DISKCACHESIZE)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_PARALLEL)] = unicode(DEFAULT_PARALLEL)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_PARALLELMINSIZE)] = unicode(DEFAULT_PARALLELMINSIZE)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_WARMUP)] = unicode(DEFAULT_WARMUP)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_INCREMENTAL)] = unicode(DEFAULT_INCREMENTAL)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_MAXSIZE)] = unicode(DEFAULT_MAXSIZE)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_MAXLINES)] = unicode(DEFAULT_MAXLINES)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_TIMELIMIT)] = unicode(DEFAULT_TIMELIMIT)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_ASYNC)] = unicode(DEFAULT_ASYNC)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_PREFETCH)] = unicode(DEFAULT_PREFETCH)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_CODEINDEX)] = unicode(DEFAULT_CODEINDEX)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_STATS)] = unicode(DEFAULT_STATS)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_STATSFILE)] = DEFAULT_STATSFILE
+        app.getDefaultGlobalConfigDict()[("main", OPTION_CSSCLASSES)] = unicode(DEFAULT_CSSCLASSES)
+        app.getDefaultGlobalConfigDict()[("main", OPTION_COMPACTHTML)] = unicode(DEFAULT_COMPACTHTML)
     def __init__(self, config):
         """
         Constructor
@@ -112,8 +676,28 @@ class Options(object):
         self.config = config
         self.lang = self.config.get("main", OPTION_LANG, DEFAULT_LANG)
         self.showLN = self.config.getboolean("main", OPTION_SHOWLN, DEFAULT_SHOWLN)
-        self.bkgs = eval(self.config.get("main", OPTION_BKGS, unicode(DEFAULT_BKGS)))
+        self.bkgs = parseBkgs(self.config.get("main", OPTION_BKGS, unicode(DEFAULT_BKGS)))
+        # backgrounds by lower case Id
+        self.bkgsLower = dict(zip([x.lower() for x in self.bkgs.keys()], self.bkgs.values()))
         self.bkg = self.config.get("main", OPTION_BKG, DEFAULT_BKG)
+        self.cacheSize = self.config.getint("main", OPTION_CACHESIZE, DEFAULT_CACHESIZE)
+        self.cacheMemory = self.config.getint("main", OPTION_CACHEMEMORY, DEFAULT_CACHEMEMORY)
+        self.cachePersist = self.config.getboolean("main", OPTION_CACHEPERSIST, DEFAULT_CACHEPERSIST)
+        self.diskCacheSize = self.config.getint("main", OPTION_DISKCACHESIZE, DEFAULT_DISKCACHESIZE)
+        self.parallel = self.config.getboolean("main", OPTION_PARALLEL, DEFAULT_PARALLEL)
+        self.parallelMinSize = self.config.getint("main", OPTION_PARALLELMINSIZE, DEFAULT_PARALLELMINSIZE)
+        self.warmUp = self.config.getboolean("main", OPTION_WARMUP, DEFAULT_WARMUP)
+        self.incremental = self.config.getboolean("main", OPTION_INCREMENTAL, DEFAULT_INCREMENTAL)
+        self.maxSize = self.config.getint("main", OPTION_MAXSIZE, DEFAULT_MAXSIZE)
+        self.maxLines = self.config.getint("main", OPTION_MAXLINES, DEFAULT_MAXLINES)
+        self.timeLimit = self.config.getint("main", OPTION_TIMELIMIT, DEFAULT_TIMELIMIT)
+        self.asyncPreview = self.config.getboolean("main", OPTION_ASYNC, DEFAULT_ASYNC)
+        self.prefetch = self.config.getboolean("main", OPTION_PREFETCH, DEFAULT_PREFETCH)
+        self.codeIndex = self.config.getboolean("main", OPTION_CODEINDEX, DEFAULT_CODEINDEX)
+        self.stats = self.config.getboolean("main", OPTION_STATS, DEFAULT_STATS)
+        self.statsFile = self.config.get("main", OPTION_STATSFILE, DEFAULT_STATSFILE)
+        self.cssClasses = self.config.getboolean("main", OPTION_CSSCLASSES, DEFAULT_CSSCLASSES)
+        self.compactHtml = self.config.getboolean("main", OPTION_COMPACTHTML, DEFAULT_COMPACTHTML)
         self.startLine = 1
         self.hlLines = []
     def save(self):
@@ -124,6 +708,1063 @@ class Options(object):
         self.config.set("main", OPTION_SHOWLN, unicode(self.showLN))
         self.config.set("main", OPTION_BKGS, unicode(self.bkgs))
         self.config.set("main", OPTION_BKG, self.bkg)
+        self.config.set("main", OPTION_CACHESIZE, unicode(self.cacheSize))
+        self.config.set("main", OPTION_CACHEMEMORY, unicode(self.cacheMemory))
+        self.config.set("main", OPTION_CACHEPERSIST, unicode(self.cachePersist))
+        self.config.set("main", OPTION_DISKCACHESIZE, unicode(self.diskCacheSize))
+        self.config.set("main", OPTION_PARALLEL, unicode(self.parallel))
+        self.config.set("main", OPTION_PARALLELMINSIZE, unicode(self.parallelMinSize))
+        self.config.set("main", OPTION_WARMUP, unicode(self.warmUp))
+        self.config.set("main", OPTION_INCREMENTAL, unicode(self.incremental))
+        self.config.set("main", OPTION_MAXSIZE, unicode(self.maxSize))
+        self.config.set("main", OPTION_MAXLINES, unicode(self.maxLines))
+        self.config.set("main", OPTION_TIMELIMIT, unicode(self.timeLimit))
+        self.config.set("main", OPTION_ASYNC, unicode(self.asyncPreview))
+        self.config.set("main", OPTION_PREFETCH, unicode(self.prefetch))
+        self.config.set("main", OPTION_CODEINDEX, unicode(self.codeIndex))
+        self.config.set("main", OPTION_STATS, unicode(self.stats))
+        self.config.set("main", OPTION_STATSFILE, self.statsFile)
+        self.config.set("main", OPTION_CSSCLASSES, unicode(self.cssClasses))
+        self.config.set("main", OPTION_COMPACTHTML, unicode(self.compactHtml))
+        invalidateOptions()
+
+######################################################################################
+# Insertion options
+######################################################################################
+class OptionError(ValueError):
+    """
+    An invalid option in the options of an insertion
+    """
+    def __init__(self, message, column, source):
+        """
+        Constructor
+        @param message: the description of the error
+        @param column: the column of the error (starting at 1)
+        @param source: the part of the insertion holding the options
+        """
+        ValueError.__init__(self, u"%s at column %d of the %s" % (message, column, source))
+        self.column = column
+        self.source = source
+
+class InsertionOptions(namedtuple("InsertionOptions",
+        "lang showLN startLine hlLines bkg maxSize maxLines timeLimit file")):
+    """
+    The options of an insertion, None for the options not set
+    """
+    __slots__ = ()
+    def update(self, other):
+        """
+        Return the options overridden by the options set in other
+        """
+        return InsertionOptions(*[o if o is not None else s for s, o in zip(self, other)])
+    def resolve(self, options):
+        """
+        Return the options of the block, the options not set come from the plugin options
+        """
+        defaults = (options.lang, bool(options.showLN), options.startLine, tuple(options.hlLines),
+                options.bkg, options.maxSize, options.maxLines, options.timeLimit, None)
+        return InsertionOptions(*[s if s is not None else d for s, d in zip(self, defaults)])
+
+NO_OPTIONS = InsertionOptions(*[None] * len(InsertionOptions._fields))
+
+def _parseHlLines(value):
+    if value:
+        return tuple([int(x) for x in value.split(u",")])
+    return ()
+
+def _parseBkg(value):
+    if value == u"default":
+        return None
+    return value
+
+# option name -> (field of InsertionOptions, value parser)
+OPTION_PARSERS = {
+        u"lang": ("lang", unicode),
+        u"showlines": ("showLN", lambda value: int(value) != 0),
+        u"startline": ("startLine", int),
+        u"hllines": ("hlLines", _parseHlLines),
+        u"bkg": ("bkg", _parseBkg),
+        u"maxsize": ("maxSize", int),
+        u"maxlines": ("maxLines", int),
+        u"timelimit": ("timeLimit", int),
+        u"file": ("file", unicode),
+        }
+
+# one "name=value" (or "name:value") item of the options
+OPTION_RE = re.compile(r"(?:(?P<name>[^=;]*)=|(?P<altName>[^:;]*):)\s*(?P<value>[^;]*)(?P<sep>;?)", re.UNICODE)
+
+# parsed option strings: (text, source) -> InsertionOptions or OptionError
+optionStrings = {}
+OPTION_STRINGS_MAX = 4096
+
+def parseOptionString(text, source=u"options"):
+    """
+    Parse options "name1=value1;name2=value2;..."
+    Return an InsertionOptions, raise OptionError
+    The results are memoized on the text and the source, which the errors report
+    """
+    result = optionStrings.get((text, source))
+    if result is None:
+        try:
+            result = _parseOptionString(text, source)
+        except OptionError, e:
+            result = e
+        if len(optionStrings) >= OPTION_STRINGS_MAX:
+            optionStrings.clear()
+        optionStrings[text, source] = result
+    if isinstance(result, OptionError):
+        raise result
+    return result
+
+def _parseOptionString(text, source):
+    values = {}
+    pos = 0
+    while True:
+        m = OPTION_RE.match(text, pos)
+        if m is None:
+            raise OptionError(u"expected 'name=value'", pos + 1, source)
+        nameGroup = m.group("name") is not None and "name" or "altName"
+        name = m.group(nameGroup).strip().lower()
+        try:
+            field, parse = OPTION_PARSERS[name]
+        except KeyError:
+            raise OptionError(u"invalid option name '%s'" % name, m.start(nameGroup) + 1, source)
+        value = m.group("value").strip()
+        try:
+            values[field] = parse(value)
+        except ValueError:
+            raise OptionError(u"invalid value '%s' of the option '%s'" % (value, name),
+                    m.start("value") + 1, source)
+        if not m.group("sep"):
+            if m.end() < len(text):
+                raise OptionError(u"expected ';'", m.end() + 1, source)
+            break
+        pos = m.end()
+    return NO_OPTIONS._replace(**values)
+
+def parseInsertion(value, appendices):
+    """
+    Split the value of an insertion into the code and the options
+    Return (code, InsertionOptions) or (code, None) if no option is set,
+    raise OptionError
+    """
+    try:
+        code, soptions = value.rsplit(u":::", 1)
+    except ValueError:
+        code = value
+        options = None
+    else:
+        options = parseOptionString(soptions)
+    for i, appendix in enumerate(appendices):
+        appendixOptions = parseOptionString(appendix, u"appendix %d" % (i + 1))
+        if options is None:
+            options = appendixOptions
+        else:
+            options = options.update(appendixOptions)
+    return code, options
+
+######################################################################################
+# Render cache
+######################################################################################
+class CacheEntry(object):
+    """
+    A rendered block of the render cache, zlib compressed above
+    CACHE_COMPRESS_MIN_SIZE characters
+    """
+    __slots__ = ("data", "compressed", "size")
+    def __init__(self, result):
+        """
+        Constructor
+        @param result: the HTML code of the block
+        """
+        self.compressed = len(result) >= CACHE_COMPRESS_MIN_SIZE
+        if self.compressed:
+            self.data = zlib.compress(result.encode("utf-8"), 1)
+        else:
+            self.data = result
+        self.size = sys.getsizeof(self.data)
+    def getResult(self):
+        """
+        Return the HTML code of the block
+        """
+        if self.compressed:
+            return zlib.decompress(self.data).decode("utf-8")
+        return self.data
+
+class RenderCache(object):
+    """
+    LRU cache of the rendered insertions, keyed on the content, bounded
+    by a number of blocks and by the memory they use
+    """
+    def __init__(self, maxEntries=DEFAULT_CACHESIZE, maxBytes=DEFAULT_CACHEMEMORY << 20):
+        """
+        Constructor
+        @param maxEntries: the maximal number of rendered blocks to keep
+        @param maxBytes: the maximal memory used by the rendered blocks
+        """
+        self.maxEntries = max(0, maxEntries)
+        self.maxBytes = max(0, maxBytes)
+        # key -> CacheEntry
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the cache is shared with the background rendering thread
+        self.lock = threading.RLock()
+    @staticmethod
+    def makeKey(code, options, bkg, exportType):
+        """
+        Build the cache key of a block
+        @param code: the source code
+        @param options: the resolved options of the block
+        @param bkg: the resolved background style
+        @param exportType: the export type
+        """
+        digest = hashlib.sha1(code.encode("utf-8", "replace")).hexdigest()
+        return (digest, options.lang.lower(), bool(options.showLN), options.startLine,
+                tuple(options.hlLines), bkg, options.maxSize, options.maxLines, options.timeLimit,
+                exportType)
+    def get(self, key):
+        """
+        Return the rendered block for the key or None
+        """
+        with self.lock:
+            try:
+                entry = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # move the entry to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+        return entry.getResult()
+    def put(self, key, result):
+        """
+        Store a rendered block, evicting the least recently used ones
+        Return the CacheEntry of the block or None if it is not kept
+        """
+        if self.maxEntries == 0 or self.maxBytes == 0:
+            return None
+        entry = CacheEntry(result)
+        if entry.size > self.maxBytes:
+            return None
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous.size
+            self.entries[key] = entry
+            self.bytes += entry.size
+            self.evict()
+        return entry
+    def evict(self):
+        """
+        Drop the least recently used blocks above the limits
+        """
+        while len(self.entries) > self.maxEntries or self.bytes > self.maxBytes:
+            self.bytes -= self.entries.popitem(last=False)[1].size
+            self.evictions += 1
+    def resize(self, maxEntries, maxBytes):
+        """
+        Change the limits of the cache
+        """
+        with self.lock:
+            self.maxEntries = max(0, maxEntries)
+            self.maxBytes = max(0, maxBytes)
+            self.evict()
+    def clear(self):
+        """
+        Drop all the entries and reset the statistics
+        """
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+    def getStats(self):
+        """
+        Return a dictionary with the cache statistics
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                    "entries": len(self.entries),
+                    "maxEntries": self.maxEntries,
+                    "bytes": self.bytes,
+                    "maxBytes": self.maxBytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hitRatio": float(self.hits) / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    }
+
+# the cache shared by all the insertion handlers
+renderCache = None
+
+def getRenderCache(app, options):
+    """
+    Return the render cache, create it at first call
+    @param app: the application
+    @param options: the plugin options
+    """
+    global renderCache
+    if renderCache is None:
+        renderCache = RenderCache(options.cacheSize, options.cacheMemory << 20)
+    elif renderCache.maxEntries != options.cacheSize or renderCache.maxBytes != options.cacheMemory << 20:
+        renderCache.resize(options.cacheSize, options.cacheMemory << 20)
+    return renderCache
+
+class DiskCache(object):
+    """
+    Rendered blocks kept compressed in an SQLite database, shared by the
+    sessions and the WikidPad processes using the same wiki
+    The writes and the use times of the read blocks are buffered and
+    written in one transaction by flush()
+    """
+    # number of written blocks buffered before a flush
+    FLUSH_SIZE = 64
+    def __init__(self, app, path, maxSize):
+        """
+        Constructor
+        @param app: the application
+        @param path: the path of the database
+        @param maxSize: the maximal size of the compressed blocks in bytes
+        """
+        self.app = app
+        self.path = path
+        self.maxSize = maxSize
+        self.version = None
+        self.connection = None
+        self.failed = False
+        # the background rendering thread uses the cache too
+        self.lock = threading.RLock()
+        # database key -> rendered block, not written yet
+        self.writes = OrderedDict()
+        # the database keys of the read blocks
+        self.reads = set()
+        self.lastFlush = time.time()
+    def connect(self):
+        """
+        Return the connection to the database or None if it cannot be opened
+        """
+        if self.connection is None and not self.failed:
+            try:
+                import sqlite3
+                connection = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("CREATE TABLE IF NOT EXISTS blocks "
+                    "(key TEXT PRIMARY KEY, value BLOB, size INTEGER, used REAL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS blocks_used ON blocks (used)")
+                connection.commit()
+            except Exception:
+                self.failed = True
+                return None
+            # the blocks highlighted by another version are not used
+            import_Pygments(self.app)
+            self.version = (CACHE_VERSION, getattr(pygments, "__version__", None))
+            self.connection = connection
+        return self.connection
+    def makeKey(self, key):
+        """
+        Return the database key of a render cache key
+        """
+        return hashlib.sha1(repr((self.version, key))).hexdigest()
+    def get(self, key):
+        """
+        Return the rendered block for the render cache key or None
+        """
+        with self.lock:
+            connection = self.connect()
+            if connection is None:
+                return None
+            dbKey = self.makeKey(key)
+            result = self.writes.get(dbKey)
+            if result is not None:
+                return result
+            try:
+                row = connection.execute("SELECT value FROM blocks WHERE key = ?", (dbKey,)).fetchone()
+            except Exception:
+                return None
+            if row is None:
+                return None
+            self.reads.add(dbKey)
+        try:
+            return zlib.decompress(str(row[0])).decode("utf-8")
+        except (zlib.error, UnicodeDecodeError):
+            return None
+    def put(self, key, result):
+        """
+        Store a rendered block, written at the next flush
+        """
+        with self.lock:
+            if self.connect() is None:
+                return
+            self.writes[self.makeKey(key)] = result
+            if len(self.writes) >= self.FLUSH_SIZE or time.time() - self.lastFlush > CACHE_FLUSH_INTERVAL:
+                self.flush()
+    def flush(self):
+        """
+        Write the buffered blocks and use times, then drop the least
+        recently used blocks above the maximal size
+        """
+        with self.lock:
+            writes, self.writes = self.writes, OrderedDict()
+            reads, self.reads = self.reads, set()
+            self.lastFlush = time.time()
+            if (not writes and not reads) or self.connection is None:
+                return
+            now = time.time()
+            rows = []
+            for dbKey, result in writes.iteritems():
+                value = zlib.compress(result.encode("utf-8"))
+                rows.append((dbKey, buffer(value), len(value), now))
+            try:
+                with self.connection:
+                    self.connection.executemany("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?)", rows)
+                    self.connection.executemany("UPDATE blocks SET used = ? WHERE key = ?",
+                        [(now, dbKey) for dbKey in reads])
+                    self.evict()
+            except Exception:
+                pass
+    def evict(self):
+        """
+        Drop the least recently used blocks down to 90% of the maximal size
+        """
+        total = self.connection.execute("SELECT TOTAL(size) FROM blocks").fetchone()[0]
+        if total <= self.maxSize:
+            return
+        excess = total - self.maxSize * 0.9
+        keys = []
+        for dbKey, size in self.connection.execute("SELECT key, size FROM blocks ORDER BY used"):
+            if excess <= 0:
+                break
+            keys.append((dbKey,))
+            excess -= size
+        self.connection.executemany("DELETE FROM blocks WHERE key = ?", keys)
+
+# the disk caches by database path
+diskCaches = {}
+
+def getWikiDataDir(app, exporter):
+    """
+    Return the data directory of the exported wiki, or of the wiki open in
+    the main window, or the configuration directory as a fallback
+    """
+    wikiDocument = getattr(exporter, "wikiDocument", None)
+    if wikiDocument is None:
+        try:
+            wikiDocument = app.GetTopWindow().getWikiDocument()
+        except Exception:
+            wikiDocument = None
+    getDataDir = getattr(wikiDocument, "getDataDir", None)
+    if getDataDir is not None:
+        try:
+            return getDataDir()
+        except Exception:
+            pass
+    getSubDir = getattr(app, "getGlobalConfigSubDir", None)
+    if getSubDir is None:
+        return None
+    return getSubDir()
+
+def getCodeFilesDir(app, exporter):
+    """
+    Return the directory of the code files of the wiki (see the file option)
+    or None if unknown
+    """
+    dataDir = getWikiDataDir(app, exporter)
+    if not dataDir:
+        return None
+    return os.path.join(dataDir, CODE_FILES_DIRNAME)
+
+# the contents of the code files: path -> (modification time, size, code)
+codeFiles = OrderedDict()
+CODE_FILES_MAX = 16
+
+def readCodeFile(directory, name):
+    """
+    Return the code of a file of the code files directory
+    Raise IOError if it cannot be read, ValueError if the name is not valid
+    """
+    path = os.path.normpath(os.path.join(directory, name))
+    if not path.startswith(os.path.join(directory, "")):
+        raise ValueError("file outside of %s: %r" % (directory, name))
+    st = os.stat(path)
+    cached = codeFiles.pop(path, None)
+    if cached is not None and cached[:2] == (st.st_mtime, st.st_size):
+        code = cached[2]
+    else:
+        f = open(path, "rb")
+        try:
+            code = f.read().decode("utf-8", "replace")
+        finally:
+            f.close()
+    codeFiles[path] = (st.st_mtime, st.st_size, code)
+    while len(codeFiles) > CODE_FILES_MAX:
+        codeFiles.popitem(last=False)
+    return code
+
+def getDiskCache(app, exporter, options):
+    """
+    Return the disk cache of the wiki or None if the option is not set
+    """
+    if not options.cachePersist:
+        return None
+    dataDir = getWikiDataDir(app, exporter)
+    if not dataDir:
+        return None
+    path = os.path.join(dataDir, CACHE_FILENAME)
+    cache = diskCaches.get(path)
+    if cache is None:
+        cache = DiskCache(app, path, options.diskCacheSize << 20)
+        diskCaches[path] = cache
+    cache.maxSize = options.diskCacheSize << 20
+    return cache
+
+def flushDiskCaches():
+    """
+    Write the buffered blocks of the disk caches
+    """
+    for cache in diskCaches.values():
+        cache.flush()
+
+######################################################################################
+# Highlighting
+######################################################################################
+class InstancePool(object):
+    """
+    Reusable instances created on demand from their construction parameters
+    The pool is used from the export, background and warm up threads: the
+    pooled lexers and formatters keep no state between their calls
+    """
+    def __init__(self, factory, maxSize=None):
+        """
+        Constructor
+        @param factory: called with the items of the key to create an instance
+        @param maxSize: the maximal number of instances kept, None for no limit
+        """
+        self.factory = factory
+        self.maxSize = maxSize
+        self.instances = OrderedDict()
+        self.lock = threading.Lock()
+    def get(self, key):
+        """
+        Return the instance for the key, create it if needed
+        """
+        with self.lock:
+            try:
+                instance = self.instances.pop(key)
+            except KeyError:
+                instance = self.factory(*key)
+            self.instances[key] = instance
+            if self.maxSize is not None and len(self.instances) > self.maxSize:
+                self.instances.popitem(last=False)
+            return instance
+    def clear(self):
+        """
+        Drop all the instances
+        """
+        with self.lock:
+            self.instances.clear()
+
+def _createLexer(name, stripall):
+    from .pygments.lexers import get_lexer_by_name #@UnresolvedImport
+    return get_lexer_by_name(name, stripall=stripall, encoding = None)
+
+def _createFormatter(linenos, linenostart, hlLines, noclasses, compact):
+    if compact:
+        registerDependentStuff()
+        formatterClass = CompactHtmlFormatter
+    else:
+        from .pygments.formatters import HtmlFormatter #@UnresolvedImport
+        formatterClass = HtmlFormatter
+    return formatterClass(
+        cssclass="source", noclasses = noclasses, encoding = None,
+        linenos=linenos, linenostart = linenostart, hl_lines = list(hlLines),
+        )
+
+# lexers keyed by (normalized language name, stripall)
+lexerPool = InstancePool(_createLexer)
+# formatters keyed by (linenos, linenostart, hl_lines, noclasses, compact)
+formatterPool = InstancePool(_createFormatter, 64)
+
+def _createWXFormatter(linenos, linenostart, compact):
+    registerDependentStuff()
+    return WXHtmlFormatter(linenos=linenos, linenostart=linenostart, compact=compact)
+
+# formatters for html_previewWX keyed by (linenos, linenostart, compact)
+wxFormatterPool = InstancePool(_createWXFormatter, 64)
+
+def getLexer(lang, app=None):
+    """
+    Return the pooled lexer of a language
+    Raise ValueError if the language is unknown
+    @param lang: the language name or alias
+    @param app: the application (see getLanguageCatalogue)
+    """
+    alias = getLanguageCatalogue(app).resolve(lang)
+    if alias is None:
+        raise ValueError("unknown language: %r" % lang)
+    return lexerPool.get((alias, True))
+
+def getFormatter(showLN, startLine, hlLines, noclasses=True, compact=False):
+    """
+    Return the pooled HTML formatter for the given line options
+    @param noclasses: True for inline styles, False for the CSS classes of getStyleSheet()
+    @param compact: True for the merged spans and compacted styles of CompactHtmlFormatter
+    """
+    if showLN:
+        linenos = "inline"
+    else:
+        linenos = False
+    return formatterPool.get((linenos, startLine, tuple(hlLines), noclasses, compact))
+
+# the style elements of the CSS classes keyed by compact, built at first use
+styleSheets = {}
+
+def getStyleSheet(compact=False):
+    """
+    Return the style element defining the CSS classes of the formatters
+    created with noclasses=False
+    """
+    try:
+        return styleSheets[compact]
+    except KeyError:
+        styleSheet = styleSheets[compact] = u'<style type="text/css">\n%s\n</style>\n' % \
+            getFormatter(False, 1, (), False, compact).get_style_defs(".source")
+        return styleSheet
+
+def getWXFormatter(showLN, startLine, compact=False):
+    """
+    Return the pooled formatter for the wx.html previewer
+    """
+    return wxFormatterPool.get((bool(showLN), startLine, compact))
+
+# the pool of highlighting processes (see highlightInPool)
+highlightPool = None
+highlightPoolFailed = False
+
+def highlightWorker(job):
+    """
+    Highlight a block in a process of the pool
+    @param job: tuple (code, lang, showLN, startLine, hlLines, noclasses, compact)
+    """
+    code, lang, showLN, startLine, hlLines, noclasses, compact = job
+    from .pygments import highlight #@UnresolvedImport
+    return highlight(code, getLexer(lang), getFormatter(showLN, startLine, hlLines, noclasses, compact))
+
+def probeWorker():
+    """
+    Trivial job checking that the processes of the pool can import the
+    plugin and Pygments
+    """
+    from .pygments import highlight #@UnresolvedImport
+    return True
+
+def highlightInPool(jobs):
+    """
+    Highlight the jobs (see highlightWorker) in the process pool
+    Return the results in the order of the jobs or None if the pool is not usable
+    """
+    global highlightPool, highlightPoolFailed
+    if highlightPoolFailed:
+        return None
+    try:
+        if highlightPool is None:
+            import multiprocessing
+            highlightPool = multiprocessing.Pool()
+            # the workers cannot import the plugin in a frozen executable or
+            # with spawn on Windows: find it out before the first export waits
+            highlightPool.apply_async(probeWorker).get(PARALLEL_PROBE_TIMEOUT)
+        # a timeout as a broken worker process would block map() for ever
+        return highlightPool.map_async(highlightWorker, jobs, 1).get(PARALLEL_TIMEOUT)
+    except Exception:
+        highlightPoolFailed = True
+        shutdownHighlightPool()
+        return None
+
+def shutdownHighlightPool():
+    """
+    Stop the processes of the pool
+    """
+    global highlightPool
+    if highlightPool is not None:
+        highlightPool.terminate()
+        highlightPool = None
+
+######################################################################################
+# Incremental highlighting
+######################################################################################
+class LexState(object):
+    """
+    The tokens of a lexed text and the lexer state at the start of its lines
+    """
+    __slots__ = ("text", "lines", "lineStarts", "tokens", "checkpoints")
+    def __init__(self, text):
+        """
+        Constructor
+        @param text: the text preprocessed as by Lexer.get_tokens()
+        """
+        self.text = text
+        self.lines = text.split(u"\n")
+        self.lineStarts = [0]
+        pos = 0
+        for line in self.lines[:-1]:
+            pos += len(line) + 1
+            self.lineStarts.append(pos)
+        # (pos, ttype, value)
+        self.tokens = []
+        # line index -> (index of the first token of the line, lexer state stack)
+        self.checkpoints = {}
+
+def supportsIncremental(lexer):
+    """
+    Return True if the lexer runs the standard RegexLexer state machine,
+    i.e. its state at a line start is the state stack only
+    """
+    from .pygments.lexer import RegexLexer #@UnresolvedImport
+    return isinstance(lexer, RegexLexer) \
+        and type(lexer).get_tokens_unprocessed.im_func is RegexLexer.get_tokens_unprocessed.im_func \
+        and not lexer.filters
+
+def preprocessText(lexer, text):
+    """
+    Preprocess the text as Lexer.get_tokens() does
+    """
+    if text.startswith(u"\ufeff"):
+        text = text[1:]
+    text = text.replace(u"\r\n", u"\n").replace(u"\r", u"\n")
+    if lexer.stripall:
+        text = text.strip()
+    elif lexer.stripnl:
+        text = text.strip(u"\n")
+    if lexer.tabsize > 0:
+        text = text.expandtabs(lexer.tabsize)
+    if getattr(lexer, "ensurenl", True) and not text.endswith(u"\n"):
+        text += u"\n"
+    return text
+
+def lexIncremental(lexer, state, line, stack, old=None, oldLine=None, deadline=None):
+    """
+    Lex state.text from the start of a line with the given state stack,
+    append the tokens and the checkpoints to state
+    Lexing stops when the state is the same as in the old lexing at the
+    start of a line of the unchanged end of the text, the old tokens are
+    then reused.
+    This is the loop of RegexLexer.get_tokens_unprocessed() recording the
+    state stack at the line starts.
+    @param oldLine: the first line of the unchanged end in the new text
+    @param deadline: the time at which RenderTimeout is raised, None for no limit
+    """
+    from .pygments.lexer import RegexLexer #@UnresolvedImport @UnusedImport
+    from .pygments.token import Text, Error, _TokenType #@UnresolvedImport
+    text = state.text
+    tokens = state.tokens
+    checkpoints = state.checkpoints
+    lineOfPos = dict(itertools.izip(state.lineStarts, itertools.count()))
+    if old is not None:
+        lineShift = len(old.lines) - len(state.lines)
+    tokendefs = lexer._tokens
+    statestack = list(stack)
+    statetokens = tokendefs[statestack[-1]]
+    pos = state.lineStarts[line]
+    while 1:
+        if pos in lineOfPos:
+            line = lineOfPos[pos]
+            checkpoints[line] = (len(tokens), tuple(statestack))
+            if deadline is not None and not line & 0x3f and time.time() > deadline:
+                raise RenderTimeout()
+            if old is not None and line >= oldLine:
+                checkpoint = old.checkpoints.get(line + lineShift)
+                if checkpoint is not None and checkpoint[1] == checkpoints[line][1]:
+                    # synchronized with the old lexing: reuse the rest
+                    oldTokenIndex = checkpoint[0]
+                    shift = pos - old.lineStarts[line + lineShift]
+                    tokenShift = len(tokens) - oldTokenIndex
+                    tokens.extend([(p + shift, t, v) for p, t, v in old.tokens[oldTokenIndex:]])
+                    for oldLineIndex, (tokenIndex, oldStack) in old.checkpoints.iteritems():
+                        if oldLineIndex > line + lineShift:
+                            checkpoints[oldLineIndex - lineShift] = (tokenIndex + tokenShift, oldStack)
+                    return
+        for rexmatch, action, new_state in statetokens:
+            m = rexmatch(text, pos)
+            if m:
+                if action is not None:
+                    if type(action) is _TokenType:
+                        tokens.append((pos, action, m.group()))
+                    else:
+                        tokens.extend(action(lexer, m))
+                pos = m.end()
+                if new_state is not None:
+                    # state transition
+                    if isinstance(new_state, tuple):
+                        for st in new_state:
+                            if st == '#pop':
+                                if len(statestack) > 1:
+                                    statestack.pop()
+                            elif st == '#push':
+                                statestack.append(statestack[-1])
+                            else:
+                                statestack.append(st)
+                    elif isinstance(new_state, int):
+                        if abs(new_state) >= len(statestack):
+                            del statestack[1:]
+                        else:
+                            del statestack[new_state:]
+                    elif new_state == '#push':
+                        statestack.append(statestack[-1])
+                    else:
+                        assert False, "wrong state def: %r" % new_state
+                    statetokens = tokendefs[statestack[-1]]
+                break
+        else:
+            if pos >= len(text):
+                break
+            if text[pos] == u"\n":
+                # at EOL, reset state to "root"
+                statestack = ['root']
+                statetokens = tokendefs['root']
+                tokens.append((pos, Text, u"\n"))
+            else:
+                tokens.append((pos, Error, text[pos]))
+            pos += 1
+
+def relex(lexer, text, old, deadline=None):
+    """
+    Return the LexState of a text, reusing the lexing of the old text
+    from the last checkpoint before the first changed line until the
+    lexer state synchronizes again
+    @param text: the preprocessed text
+    @param old: a previous LexState of the same lexer or None
+    @param deadline: see lexIncremental()
+    """
+    state = LexState(text)
+    if old is None:
+        lexIncremental(lexer, state, 0, ('root',), deadline=deadline)
+        return state
+    newLines = state.lines
+    oldLines = old.lines
+    count = min(len(newLines), len(oldLines))
+    first = 0
+    while first < count and newLines[first] == oldLines[first]:
+        first += 1
+    if first == len(newLines) == len(oldLines):
+        # same text
+        state.tokens = old.tokens
+        state.checkpoints = old.checkpoints
+        return state
+    last = 0
+    while last < count - first and newLines[-1 - last] == oldLines[-1 - last]:
+        last += 1
+    # restart from the last checkpoint strictly before the changed line
+    line = first - 1
+    while line > 0 and line not in old.checkpoints:
+        line -= 1
+    if line <= 0:
+        line = 0
+        tokenIndex, stack = 0, ('root',)
+    else:
+        tokenIndex, stack = old.checkpoints[line]
+    state.tokens = old.tokens[:tokenIndex]
+    state.checkpoints = dict([(l, c) for l, c in old.checkpoints.iteritems() if l < line])
+    lexIncremental(lexer, state, line, stack, old, len(newLines) - last, deadline)
+    return state
+
+class IncrementalHighlighter(object):
+    """
+    Keep the lexing of the last large blocks of each lexer to re-lex only
+    the changed part of an edited block
+    """
+    def __init__(self, history=INCREMENTAL_HISTORY):
+        """
+        Constructor
+        @param history: the number of lexings kept per lexer
+        """
+        self.history = history
+        # lexer -> [LexState], most recent first
+        self.states = {}
+        self.lock = threading.Lock()
+    def findBase(self, states, text):
+        """
+        Return the previous lexing sharing the most lines with the text
+        """
+        best = None
+        bestScore = 0
+        lines = text.split(u"\n", 1)[0], text.rsplit(u"\n", 2)[-2:]
+        for state in states:
+            score = 0
+            if state.text == text:
+                return state
+            if state.lines[0] == lines[0]:
+                score += 1
+            if state.lines[-2:] == lines[1]:
+                score += 1
+            if score > bestScore:
+                best = state
+                bestScore = score
+        if best is None and states:
+            # any lexing gives the right tokens, the most recent one is
+            # likely the same block
+            best = states[0]
+        return best
+    def tokenize(self, lexer, code, deadline=None):
+        """
+        Return the (ttype, value) tokens of the code, or None if the block
+        is not worth or not possible to lex incrementally
+        Raise RenderTimeout if the deadline (if any) is passed
+        """
+        if code.count(u"\n") < INCREMENTAL_MIN_LINES or not supportsIncremental(lexer):
+            return None
+        text = preprocessText(lexer, code)
+        with self.lock:
+            states = self.states.setdefault(lexer, [])
+            old = self.findBase(states, text)
+        state = relex(lexer, text, old, deadline)
+        with self.lock:
+            if old in states:
+                states.remove(old)
+            states.insert(0, state)
+            del states[self.history:]
+        return [(ttype, value) for pos, ttype, value in state.tokens]
+    def clear(self):
+        """
+        Drop all the kept lexings
+        """
+        with self.lock:
+            self.states.clear()
+
+incrementalHighlighter = IncrementalHighlighter()
+
+######################################################################################
+# Token cache
+######################################################################################
+# the token types met by the lexers, the index in the list is the type id
+tokenTypes = []
+tokenTypeIds = {}
+tokenTypesLock = threading.Lock()
+
+def getTokenTypeId(tokenType):
+    """
+    Return the id of a token type, the type is registered at first call
+    """
+    with tokenTypesLock:
+        typeId = tokenTypeIds.get(tokenType)
+        if typeId is None:
+            typeId = len(tokenTypes)
+            tokenTypes.append(tokenType)
+            tokenTypeIds[tokenType] = typeId
+        return typeId
+
+class TokenStream(object):
+    """
+    The tokens of a lexed block in a compact form: the concatenated token
+    values and, for each token, its type id and the end of its value
+    """
+    __slots__ = ("text", "types", "ends")
+    def __init__(self, text, types, ends):
+        """
+        Constructor
+        @param text: the concatenated token values
+        @param types: array of the token type ids
+        @param ends: array of the offsets of the ends of the values in text
+        """
+        self.text = text
+        self.types = types
+        self.ends = ends
+    def __iter__(self):
+        """
+        Yield the tokens as the lexer did
+        """
+        text = self.text
+        types = tokenTypes
+        start = 0
+        for typeId, end in itertools.izip(self.types, self.ends):
+            yield types[typeId], text[start:end]
+            start = end
+    def getSize(self):
+        """
+        Return the approximate size of the stream in characters
+        """
+        return len(self.text) + 2 * len(self.ends)
+
+class TokenCache(object):
+    """
+    LRU cache of the token streams of the blocks keyed by (code digest,
+    lexer class), bounded by the size of the streams, so that a change of
+    the formatting options of a block does not lex it again
+    """
+    def __init__(self, maxSize=TOKEN_CACHE_SIZE):
+        """
+        Constructor
+        @param maxSize: the maximal size of the streams in characters
+        """
+        self.maxSize = maxSize
+        self.size = 0
+        self.streams = OrderedDict()
+        self.lock = threading.Lock()
+    def get(self, key):
+        """
+        Return the token stream for the key or None
+        """
+        with self.lock:
+            stream = self.streams.pop(key, None)
+            if stream is not None:
+                self.streams[key] = stream
+            return stream
+    def put(self, key, stream):
+        """
+        Store a token stream, evicting the least recently used ones
+        """
+        with self.lock:
+            previous = self.streams.pop(key, None)
+            if previous is not None:
+                self.size -= previous.getSize()
+            self.streams[key] = stream
+            self.size += stream.getSize()
+            while self.size > self.maxSize and self.streams:
+                self.size -= self.streams.popitem(last=False)[1].getSize()
+    def clear(self):
+        """
+        Drop all the streams
+        """
+        with self.lock:
+            self.streams.clear()
+            self.size = 0
+    def tokenize(self, lexer, code):
+        """
+        Return the tokens of a block, replayed from the cache if the block
+        was lexed before, or recorded while they are consumed otherwise
+        The streamed blocks (see STREAM_MIN_SIZE) are not recorded, their
+        tokens would be held in memory
+        """
+        if len(code) < TOKEN_CACHE_MIN_SIZE or len(code) >= STREAM_MIN_SIZE:
+            return lexer.get_tokens(code)
+        key = (hashlib.sha1(code.encode("utf-8", "replace")).digest(), lexer.__class__)
+        stream = self.get(key)
+        if stream is not None:
+            return iter(stream)
+        return self.record(key, lexer.get_tokens(code))
+    def record(self, key, tokens):
+        """
+        Yield the tokens and store their stream once they are all consumed
+        """
+        types = array("H")
+        ends = array("I")
+        values = []
+        pos = 0
+        for tokenType, value in tokens:
+            typeId = tokenTypeIds.get(tokenType)
+            if typeId is None:
+                typeId = getTokenTypeId(tokenType)
+            pos += len(value)
+            types.append(typeId)
+            ends.append(pos)
+            values.append(value)
+            yield tokenType, value
+        self.put(key, TokenStream(u"".join(values), types, ends))
+
+tokenCache = TokenCache()
 
 ######################################################################################
 # Menus
@@ -156,6 +1797,8 @@ def describeMenuItems(wiki):
                 None, None, updateUIElement),
             (addCodeTags, _(u"Add code tags")+u"\tCtrl+Shift-L", _(u"Surround selected source code with the appropriate tags"), 
                 None, None, updateUIElement),
+            (showCodeReport, _(u"Code block report"), _(u"Index the code blocks of the wiki and show their languages, the largest and the slowest ones"), 
+                None, None, updateReportUIElement),
             )
 
 def updateUIElement(wiki, evt):
@@ -176,101 +1819,186 @@ def updateUIElement(wiki, evt):
         return
     evt.Enable(True)     
 
+def updateReportUIElement(wiki, evt):
+    """
+    Update the UI element of the code block report: a wiki must be open
+    @param wiki: the wiki
+    @param evt: the event
+    """
+    evt.Enable(wiki.getWikiDocument() is not None)
+
 ######################################################################################
-# WXHtmlConverter
+# WXHtmlFormatter, CompactHtmlFormatter
 ######################################################################################
-WXHtmlConverter = None
+WXHtmlFormatter = None
+CompactHtmlFormatter = None
+
+# the declarations of a style which show on whitespace
+VISIBLE_ON_SPACE_RE = re.compile(r"background|border|text-decoration")
+
+def compactCss(style):
+    """
+    Return the shortest equivalent of an inline style: no blanks around
+    the separators, 3 digits colors when possible
+    """
+    style = re.sub(r"\s*([:;,])\s*", r"\1", style.strip()).rstrip(";")
+    return re.sub(r"#([0-9a-fA-F])\1([0-9a-fA-F])\2([0-9a-fA-F])\3\b", r"#\1\2\3", style)
+
 def _registerDependentStuff():
     """
-    Register all the stuff dependent on libraries not in the original binaries
-    This is needed for binary distribution
+    Register all the stuff dependent on Pygments
+    This is needed as Pygments is imported on demand
     """
-    import HTMLParser
-    class _WXHtmlConverter(HTMLParser.HTMLParser):
+    from .pygments.formatter import Formatter #@UnresolvedImport
+    class _WXHtmlFormatter(Formatter):
         """
-        Converts Pygments HTML to a format suitable to wx.HTMLWiget
+        Formats the tokens with the markup understood by wx.html: font, b, i
+        The markup of each token type is computed once from the style
         """
-        def __init__(self):
-            HTMLParser.HTMLParser.__init__(self)
-            self.out = cStringIO.StringIO()
-            self.stack = []
-        def handle_starttag(self, tag, attrs):
-            if tag.lower() != "span":
-                # "normal" tag
-                self.out.write("<")
-                self.out.write(tag)
-                for attr, val in attrs:
-                    self.out.write(" ")
-                    self.out.write(attr)
-                    self.out.write('="')
-                    self.out.write(self.encode(val))
-                    self.out.write('"')
-                self.out.write(">")
-                return
-            # replace "color=" => "font color="
-            # replace "font-weight=" => "b"
-            # ...
-            stack = []
-            for attr, val in attrs:
-                self.out.write(" ")
-                if attr.lower() == "style":
-                    val = val.lower()
-                    for spec in val.split(';'):
-                        sattr, sval = spec.split(":")
-                        sattr = sattr.strip()
-                        sval = sval.strip()
-                        if sattr == "color":
-                            self.out.write('<font color="')
-                            self.out.write(self.encode(sval))
-                            self.out.write('">')
-                            stack.append("</font>")
-                        elif sattr == "font-weight":
-                            if sval == "bold":
-                                self.out.write('<b>')
-                                stack.append("</b>")
-                        elif sattr == "font-style":
-                            if sval == "italic":
-                                self.out.write('<i>')
-                                stack.append("</i>")
-            stack.reverse()
-            self.stack.append(stack)
-        def handle_endtag(self, tag):
-            if tag.lower() != "span":
-                # "normal" tag
-                self.out.write("</")
-                self.out.write(tag)
-                self.out.write(">")
-                return
-            for tag in self.stack.pop():
-                self.out.write(tag)
-        def handle_charref(self, name):
-            self.out.write("&#")
-            self.out.write(name)
-            self.out.write(";")
-        def handle_entityref(self, name):
-            self.out.write("&")
-            self.out.write(name)
-            self.out.write(";")
-        def handle_data(self, data):
-            self.out.write(data)
-        def handle_comment(self, data):
-            pass
-        def handle_decl(self, decl):
-            pass
-        def handle_pi(self, data):
-            pass
-        def encode(self, s):
-            s = s.replace("&", "&amp;") # Must be first
-            s = s.replace("<", "&lt;")
-            s = s.replace(">", "&gt;")
-            s = s.replace("'", "&apos;")
-            s = s.replace('"', "&quot;")
-            return s
-    global WXHtmlConverter
-    WXHtmlConverter = _WXHtmlConverter
+        name = "WX HTML"
+        aliases = []
+        def __init__(self, **options):
+            Formatter.__init__(self, **options)
+            self.linenos = bool(options.get("linenos", False))
+            self.linenostart = abs(int(options.get("linenostart", 1)))
+            # the whitespace takes the markup around it, which does not show on it
+            self.compact = bool(options.get("compact", False))
+            self.markup = {}
+            for ttype, ndef in self.style:
+                start = ""
+                end = ""
+                if ndef["color"]:
+                    start += '<font color="#%s">' % ndef["color"].lower()
+                    end = "</font>" + end
+                if ndef["bold"]:
+                    start += "<b>"
+                    end = "</b>" + end
+                if ndef["italic"]:
+                    start += "<i>"
+                    end = "</i>" + end
+                self.markup[ttype] = (start, end)
+        def getMarkup(self, ttype):
+            """
+            Return the (start, end) markup of a token type
+            """
+            try:
+                return self.markup[ttype]
+            except KeyError:
+                # token types unknown to the style use the markup of their parent
+                parent = ttype
+                while parent not in self.markup:
+                    parent = parent.parent
+                markup = self.markup[ttype] = self.markup[parent]
+                return markup
+        def format_unencoded(self, tokensource, outfile):
+            write = outfile.write
+            if self.linenos:
+                tokensource = list(tokensource)
+                lineCount = sum([value.count(u"\n") for ttype, value in tokensource])
+                numberFormat = u"%%%dd " % len(str(max(lineCount + self.linenostart - 1, 1)))
+            lineno = self.linenostart
+            lineStart = True
+            end = u""
+            current = None
+            compact = self.compact
+            write(u'<div class="source"><pre>')
+            for ttype, value in tokensource:
+                markup = self.getMarkup(ttype)
+                value = value.replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;")
+                for i, part in enumerate(value.split(u"\n")):
+                    if i:
+                        # close the markup at the line end, the next line begins with its number
+                        write(end)
+                        end = u""
+                        current = None
+                        if lineStart and self.linenos:
+                            write(numberFormat % lineno)
+                        write(u"\n")
+                        lineno += 1
+                        lineStart = True
+                    if not part:
+                        continue
+                    if lineStart:
+                        if self.linenos:
+                            write(numberFormat % lineno)
+                        lineStart = False
+                    if markup != current and not (compact and part.isspace()):
+                        # adjacent tokens with the same markup share the tags
+                        write(end)
+                        write(markup[0])
+                        end = markup[1]
+                        current = markup
+                    write(part)
+            write(end)
+            write(u"</pre></div>\n")
+    from .pygments.formatters import HtmlFormatter #@UnresolvedImport
+    from .pygments.token import Token #@UnresolvedImport
+    class _CompactHtmlFormatter(HtmlFormatter):
+        """
+        HTML formatter writing the shortest equivalent markup: the adjacent
+        tokens of the same style share one span, the whitespace is not
+        styled when the style does not show on it and the styles are compacted
+        """
+        def __init__(self, **options):
+            HtmlFormatter.__init__(self, **options)
+            for cls, (style, ttype, level) in self.class2style.items():
+                self.class2style[cls] = (compactCss(style), ttype, level)
+            # token type -> (token type standing for its style, style shown on whitespace)
+            self.styleTypes = {}
+            self.typeOfStyle = {}
+        def getStyleType(self, ttype):
+            """
+            Return the token type rendered like ttype, the first one met with
+            its style, and whether the style shows on whitespace
+            """
+            try:
+                return self.styleTypes[ttype]
+            except KeyError:
+                pass
+            parent = ttype
+            cls = self.ttype2class.get(parent)
+            while cls is None and parent.parent is not None:
+                parent = parent.parent
+                cls = self.ttype2class.get(parent)
+            style = cls and self.class2style[cls][0] or u""
+            styleType = self.styleTypes[ttype] = (self.typeOfStyle.setdefault(style, ttype),
+                bool(VISIBLE_ON_SPACE_RE.search(style)))
+            return styleType
+        def mergeTokens(self, tokensource):
+            """
+            Yield the tokens with the adjacent tokens of the same style merged,
+            the whitespace goes with the preceding token if it does not show
+            """
+            getStyleType = self.getStyleType
+            current = None
+            currentVisible = True
+            values = []
+            for ttype, value in tokensource:
+                styleType, visible = getStyleType(ttype)
+                if styleType is current:
+                    values.append(value)
+                    continue
+                if not visible and value.isspace():
+                    if current is None:
+                        current, currentVisible = getStyleType(Token.Text)
+                    if not currentVisible:
+                        values.append(value)
+                        continue
+                if values:
+                    yield current, u"".join(values)
+                current = styleType
+                currentVisible = visible
+                values = [value]
+            if values:
+                yield current, u"".join(values)
+        def format_unencoded(self, tokensource, outfile):
+            HtmlFormatter.format_unencoded(self, self.mergeTokens(tokensource), outfile)
+    global WXHtmlFormatter, CompactHtmlFormatter
+    WXHtmlFormatter = _WXHtmlFormatter
+    CompactHtmlFormatter = _CompactHtmlFormatter
 
 def registerDependentStuff():
-    if not WXHtmlConverter:
+    if not WXHtmlFormatter:
         _registerDependentStuff()
 
 ######################################################################################
@@ -283,12 +2011,49 @@ def registerOptions(ver, app):
     ver -- API version (can only be 1 currently)
     app -- wxApp object
     """
-    import_Pygments(app)
-    registerDependentStuff()
+    start = time.time()
+    # Pygments is loaded at first use or by the warm-up
     # Register options
     Options.register(app)
     # Register panel in options dialog
     app.addOptionsDlgPanel(OptionsPanel, _(u"Pretty Code"))
+    try:
+        wx.CallLater(WARMUP_DELAY, startWarmUp, app)
+    except Exception:
+        pass
+    recordTiming("registration", start)
+
+def startWarmUp(app):
+    """
+    Start loading Pygments in the background if the option is set
+    """
+    try:
+        options = Options.get(app.getGlobalConfig())
+    except Exception:
+        return
+    if not options.warmUp:
+        return
+    thread = threading.Thread(target=warmUp, args=(app, options.lang))
+    thread.setDaemon(True)
+    thread.start()
+
+def warmUp(app, lang):
+    """
+    Load Pygments, the language catalogue, the lexer of the default language
+    and the lexers of the keyword index of the language detection
+    """
+    start = time.time()
+    try:
+        import_Pygments(app)
+        registerDependentStuff()
+        from .pygments.formatters import HtmlFormatter #@UnresolvedImport @UnusedImport
+        if lang.lower() != AUTO_LANG:
+            getLexer(lang, app)
+        for alias, patterns in getKeywordIndex():
+            getLexer(alias, app)
+    except Exception:
+        return
+    recordTiming("warm-up", start)
 
 try:
     #######################################
@@ -690,134 +2455,1018 @@ class DictEdit(wx.ListCtrl,
                 if sel: self.listChoices.SetSelection(i)
         wx.ListCtrl.SetStringItem(self, index, col, data)
 
-class OptionsPanel(wx.Panel):
+class OptionsPanel(wx.Panel):
+    """
+    The option panel for the plugin
+    """
+    def __init__(self, parent, optionsDlg, app):
+        """
+        Constructor
+        """
+        global pygments
+        import_Pygments(app)
+        registerDependentStuff()
+        #
+        wx.Panel.__init__(self, parent)
+        self.app = app
+        #
+        self.options = Options(self.app.getGlobalConfig())
+        #
+        langs = [AUTO_LANG] + list(getLanguageCatalogue(app).names)
+        #
+        mainSizer = wx.BoxSizer(wx.VERTICAL)
+        #
+        box = wx.StaticBox(self, -1, _("Default options"))
+        boxSizer = wx.StaticBoxSizer(box, wx.VERTICAL)
+        gridSizer = wx.FlexGridSizer(cols=2, hgap=5, vgap=5)
+        lLang = wx.StaticText(self, -1, _("Language:"))
+        self.lang = wx.Choice(self, -1, choices = langs)
+        if not self.lang.SetStringSelection(self.options.lang):
+            self.lang.SetStringSelection(DEFAULT_LANG)
+        lBkg = wx.StaticText(self, -1, _("Background:"))
+        self.bkg = wx.Choice(self, -1, choices = [NO_BKG] + self.options.bkgs.keys())
+        if not self.bkg.SetStringSelection(self.options.bkg):
+            self.bkg.SetSelection(0)
+        self.lineNb = wx.CheckBox(self, -1, _("Show line numbers"))
+        self.lineNb.SetValue(self.options.showLN)
+        gridSizer.Add(lLang, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+        gridSizer.Add(self.lang, 0, wx.EXPAND)
+        gridSizer.Add(lBkg, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+        gridSizer.Add(self.bkg, 0, wx.EXPAND)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.lineNb, 0, wx.EXPAND)
+        boxSizer.Add(gridSizer, -1, wx.ALL|wx.EXPAND, 5)
+        mainSizer.Add(boxSizer, 0, wx.ALL|wx.EXPAND, 5)
+        #
+        box = wx.StaticBox(self, -1, _("Backgrounds"))
+        boxSizer = wx.StaticBoxSizer(box, wx.VERTICAL)
+        gridSizer = wx.BoxSizer(wx.HORIZONTAL)
+        addBkg = wx.BitmapButton(self, -1, wx.ArtProvider.GetBitmap(wx.ART_NEW))
+        self.Bind(wx.EVT_BUTTON, self.OnAddBkg, addBkg)
+        delBkg = wx.BitmapButton(self, -1, wx.ArtProvider.GetBitmap(wx.ART_DELETE))
+        self.Bind(wx.EVT_BUTTON, self.OnDelBkg, delBkg)
+        gridSizer.Add((10, 10), 1, flag=wx.EXPAND)
+        gridSizer.Add(addBkg, 0, flag=wx.EXPAND)
+        gridSizer.Add(delBkg, 0, flag=wx.EXPAND)
+        self.lBkgs = DictEdit(self, wx.NewId(), 
+            choices = self.options.bkgs, listChoices = self.bkg, style=wx.LC_REPORT|wx.BORDER_NONE|wx.LC_SORT_ASCENDING)
+        boxSizer.Add(gridSizer, 0, wx.EXPAND, 5)
+        boxSizer.Add(self.lBkgs, 1, wx.ALL|wx.EXPAND, 5)
+        mainSizer.Add(boxSizer, 1, wx.ALL|wx.EXPAND, 5)
+        #
+        box = wx.StaticBox(self, -1, _("Performance"))
+        boxSizer = wx.StaticBoxSizer(box, wx.VERTICAL)
+        gridSizer = wx.FlexGridSizer(cols=2, hgap=5, vgap=5)
+        lCacheSize = wx.StaticText(self, -1, _("Cached blocks:"))
+        self.cacheSize = wx.SpinCtrl(self, -1, min=0, max=100000, initial=self.options.cacheSize)
+        self.cachePersist = wx.CheckBox(self, -1, _("Keep the rendered blocks on disk, in the wiki data directory"))
+        self.cachePersist.SetValue(self.options.cachePersist)
+        lDiskCacheSize = wx.StaticText(self, -1, _("Disk cache size (MB):"))
+        self.diskCacheSize = wx.SpinCtrl(self, -1, min=1, max=100000, initial=self.options.diskCacheSize)
+        lCacheMemory = wx.StaticText(self, -1, _("Cache memory (MB):"))
+        self.cacheMemory = wx.SpinCtrl(self, -1, min=0, max=100000, initial=self.options.cacheMemory)
+        gridSizer.Add(lCacheSize, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+        gridSizer.Add(self.cacheSize, 0, wx.EXPAND)
+        gridSizer.Add(lCacheMemory, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+        gridSizer.Add(self.cacheMemory, 0, wx.EXPAND)
+        if renderCache is not None:
+            stats = renderCache.getStats()
+            lCacheStats = wx.StaticText(self, -1, _("Cache use:"))
+            cacheStats = wx.StaticText(self, -1,
+                _("%d blocks, %.1f MB, %d%% hits, %d evictions") % (stats["entries"],
+                    stats["bytes"] / 1048576.0, round(stats["hitRatio"] * 100), stats["evictions"]))
+            gridSizer.Add(lCacheStats, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+            gridSizer.Add(cacheStats, 0, wx.EXPAND)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.cachePersist, 0, wx.EXPAND)
+        gridSizer.Add(lDiskCacheSize, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+        gridSizer.Add(self.diskCacheSize, 0, wx.EXPAND)
+        self.warmUp = wx.CheckBox(self, -1, _("Load Pygments in the background after startup"))
+        self.warmUp.SetValue(self.options.warmUp)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.warmUp, 0, wx.EXPAND)
+        self.incremental = wx.CheckBox(self, -1, _("Re-highlight only the edited part of large blocks in the preview"))
+        self.incremental.SetValue(self.options.incremental)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.incremental, 0, wx.EXPAND)
+        self.asyncPreview = wx.CheckBox(self, -1, _("Highlight the large blocks of the preview in the background"))
+        self.asyncPreview.SetValue(self.options.asyncPreview)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.asyncPreview, 0, wx.EXPAND)
+        self.prefetch = wx.CheckBox(self, -1, _("Highlight the blocks of a page in the background when it is opened"))
+        self.prefetch.SetValue(self.options.prefetch)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.prefetch, 0, wx.EXPAND)
+        self.codeIndex = wx.CheckBox(self, -1, _("Update the code block index when a page is saved"))
+        self.codeIndex.SetValue(self.options.codeIndex)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.codeIndex, 0, wx.EXPAND)
+        lMaxSize = wx.StaticText(self, -1, _("Maximal block size (characters):"))
+        self.maxSize = wx.SpinCtrl(self, -1, min=0, max=1000000000, initial=self.options.maxSize)
+        lMaxLines = wx.StaticText(self, -1, _("Maximal block lines:"))
+        self.maxLines = wx.SpinCtrl(self, -1, min=0, max=100000000, initial=self.options.maxLines)
+        lTimeLimit = wx.StaticText(self, -1, _("Highlighting time limit (ms, 0 for none):"))
+        self.timeLimit = wx.SpinCtrl(self, -1, min=0, max=3600000, initial=self.options.timeLimit)
+        gridSizer.Add(lMaxSize, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+        gridSizer.Add(self.maxSize, 0, wx.EXPAND)
+        gridSizer.Add(lMaxLines, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+        gridSizer.Add(self.maxLines, 0, wx.EXPAND)
+        gridSizer.Add(lTimeLimit, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+        gridSizer.Add(self.timeLimit, 0, wx.EXPAND)
+        self.stats = wx.CheckBox(self, -1, _("Collect rendering statistics"))
+        self.stats.SetValue(self.options.stats)
+        lStatsFile = wx.StaticText(self, -1, _("Statistics file (appended at each task end):"))
+        self.statsFile = wx.TextCtrl(self, -1, self.options.statsFile)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.stats, 0, wx.EXPAND)
+        gridSizer.Add(lStatsFile, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+        gridSizer.Add(self.statsFile, 0, wx.EXPAND)
+        boxSizer.Add(gridSizer, -1, wx.ALL|wx.EXPAND, 5)
+        mainSizer.Add(boxSizer, 0, wx.ALL|wx.EXPAND, 5)
+        #
+        box = wx.StaticBox(self, -1, _("Export"))
+        boxSizer = wx.StaticBoxSizer(box, wx.VERTICAL)
+        gridSizer = wx.FlexGridSizer(cols=2, hgap=5, vgap=5)
+        self.parallel = wx.CheckBox(self, -1, _("Highlight in parallel processes"))
+        self.parallel.SetValue(self.options.parallel)
+        lParallelMinSize = wx.StaticText(self, -1, _("Minimal block size (characters):"))
+        self.parallelMinSize = wx.SpinCtrl(self, -1, min=0, max=10000000, initial=self.options.parallelMinSize)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.parallel, 0, wx.EXPAND)
+        gridSizer.Add(lParallelMinSize, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
+        gridSizer.Add(self.parallelMinSize, 0, wx.EXPAND)
+        self.cssClasses = wx.CheckBox(self, -1, _("Use a shared style sheet instead of inline styles"))
+        self.cssClasses.SetValue(self.options.cssClasses)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.cssClasses, 0, wx.EXPAND)
+        self.compactHtml = wx.CheckBox(self, -1, _("Compact HTML (merged spans, short styles)"))
+        self.compactHtml.SetValue(self.options.compactHtml)
+        gridSizer.Add((10, 10))
+        gridSizer.Add(self.compactHtml, 0, wx.EXPAND)
+        boxSizer.Add(gridSizer, -1, wx.ALL|wx.EXPAND, 5)
+        mainSizer.Add(boxSizer, 0, wx.ALL|wx.EXPAND, 5)
+        #
+        self.SetSizer(mainSizer)
+        self.Fit()
+    def OnAddBkg(self, event):
+        self.lBkgs.AddNewItem(BKG_NEW, BKG_TMPL)
+    def OnDelBkg(self, event):
+        self.lBkgs.DelSelection()
+    def setVisible(self, vis):
+        """
+        Called when panel is shown or hidden. The actual wxWindow.Show()
+        function is called automatically.
+        
+        If a panel is visible and becomes invisible because another panel is
+        selected, the plugin can veto by returning False.
+        When becoming visible, the return value is ignored.
+        """
+        return True
+    def checkOk(self):
+        """
+        Called when "OK" is pressed in dialog. The plugin should check here if
+        all input values are valid. If not, it should return False, then the
+        Options dialog automatically shows this panel.
+        
+        There should be a visual indication about what is wrong (e.g. red
+        background in text field). Be sure to reset the visual indication
+        if field is valid again.
+        """
+        return True
+    def handleOk(self):
+        """
+        This is called if checkOk() returned True for all panels. Transfer here
+        all values from text fields, checkboxes, ... into the configuration
+        file.
+        """
+        self.options.lang = self.lang.GetStringSelection()
+        self.options.bkg = self.bkg.GetStringSelection()
+        self.options.showLN = self.lineNb.GetValue()
+        self.options.cacheSize = self.cacheSize.GetValue()
+        self.options.cacheMemory = self.cacheMemory.GetValue()
+        self.options.cachePersist = self.cachePersist.GetValue()
+        self.options.diskCacheSize = self.diskCacheSize.GetValue()
+        self.options.parallel = self.parallel.GetValue()
+        self.options.parallelMinSize = self.parallelMinSize.GetValue()
+        self.options.cssClasses = self.cssClasses.GetValue()
+        self.options.compactHtml = self.compactHtml.GetValue()
+        self.options.warmUp = self.warmUp.GetValue()
+        self.options.incremental = self.incremental.GetValue()
+        self.options.asyncPreview = self.asyncPreview.GetValue()
+        self.options.prefetch = self.prefetch.GetValue()
+        self.options.codeIndex = self.codeIndex.GetValue()
+        self.options.maxSize = self.maxSize.GetValue()
+        self.options.maxLines = self.maxLines.GetValue()
+        self.options.timeLimit = self.timeLimit.GetValue()
+        self.options.stats = self.stats.GetValue()
+        self.options.statsFile = self.statsFile.GetValue().strip()
+        if not self.options.incremental:
+            incrementalHighlighter.clear()
+        tokenCache.clear()
+        if backgroundRenderer is not None:
+            backgroundRenderer.reset()
+        with timedOutLock:
+            timedOutKeys.clear()
+        if not self.options.parallel:
+            shutdownHighlightPool()
+        self.options.bkgs = {}
+        for i in xrange(self.lBkgs.GetItemCount()):
+            self.options.bkgs[self.lBkgs.GetItemText(i).strip()] = self.lBkgs.GetItem(i, 1).GetText().strip()
+        self.options.save()
+
+######################################################################################
+# Insertion
+######################################################################################
+def describeInsertionKeys(ver, app):
+    """
+    API function for "InsertionByKey" plugins
+    Returns a sequence of tuples describing the supported
+    insertion keys. Each tuple has the form (insKey, exportTypes, handlerFactory)
+    where insKey is the insertion key handled, exportTypes is a sequence of
+    strings describing the supported export types and handlerFactory is
+    a factory function (normally a class) taking the wxApp object as
+    parameter and returning a handler object fulfilling the protocol
+    for "insertion by key" (see EqnHandler as example).
+    
+    This plugin uses the special export type "wikidpad_language" which is
+    not a real type like HTML export, but allows to return a string
+    which conforms to WikidPad wiki syntax and is postprocessed before
+    exporting.
+    Therefore this plugin is not bound to a specific export type.
+
+    ver -- API version (can only be 1 currently)
+    app -- wxApp object
+    """
+    return (
+            (INSERTION_TAG, ("html_single", "html_previewWX", "html_preview", "html_multi"), InsertionHandler),
+            )
+
+class InsertionError(Exception):
+    """
+    An insertion which cannot be rendered, html is the error report to insert
+    """
+    def __init__(self, html):
+        Exception.__init__(self, html)
+        self.html = html
+
+# matches the insertions in the text of a wiki page
+INSERTION_RE = re.compile(r"\[:\s*%s\s*:\s*///(.*?)///((?:\s*;[^\]]*)?)\]" % INSERTION_TAG,
+        re.DOTALL | re.UNICODE)
+
+class PageInsertion(object):
+    """
+    An insertion token found by scanning the text of a page
+    """
+    def __init__(self, match, word=None):
+        """
+        Constructor
+        @param match: the match of INSERTION_RE
+        @param word: the name of the page
+        """
+        self.key = INSERTION_TAG
+        self.value = match.group(1)
+        self.appendices = [x.strip() for x in match.group(2).split(u";") if x.strip()]
+        self.start = match.start()
+        self.word = word
+
+def findInsertions(text, word=None):
+    """
+    Yield the insertions of the plugin found in the text of a wiki page
+    @param word: the name of the page
+    """
+    for match in INSERTION_RE.finditer(text):
+        yield PageInsertion(match, word)
+
+class RenderTimeout(Exception):
+    """
+    The time limit of a block is reached
+    """
+
+class TimedOutBlock(unicode):
+    """
+    The plain text written for a block instead of its highlighting when the
+    time limit is reached: it is not cached, the key of the block is noted
+    instead (see noteTimedOut)
+    """
+
+# the keys of the blocks which reached their time limit during the session,
+# they are written as plain text at once until their code or options change
+timedOutKeys = OrderedDict()
+timedOutLock = threading.Lock()
+TIMED_OUT_KEYS_MAX = 4096
+
+def noteTimedOut(key):
+    """
+    Note that a block reached its time limit
+    """
+    with timedOutLock:
+        timedOutKeys[key] = True
+        while len(timedOutKeys) > TIMED_OUT_KEYS_MAX:
+            timedOutKeys.popitem(last=False)
+
+def isTimedOut(key):
+    """
+    Return True if a block reached its time limit during the session
+    """
+    with timedOutLock:
+        return key in timedOutKeys
+
+def limitTime(tokens, deadline):
+    """
+    Yield the tokens, raise RenderTimeout once the deadline is passed
+    """
+    count = 0
+    for token in tokens:
+        yield token
+        count += 1
+        if not count & 0xff and time.time() > deadline:
+            raise RenderTimeout()
+
+class ListWriter(object):
+    """
+    File-like object collecting the written strings, joined once by getvalue()
+    """
+    def __init__(self):
+        self.parts = []
+        self.write = self.parts.append
+    def getvalue(self):
+        return u"".join(self.parts)
+
+# the export type of the last preview, the blocks of the opened pages are
+# rendered ahead for it
+previewType = "html_previewWX"
+
+class ExportTask(object):
+    """
+    The state shared by all the insertions of an export task
+    """
+    # number of insertions rendered ahead by a batch
+    BATCH_SIZE = 64
+    # part of the render cache budget given to the blocks kept for the
+    # duplicates of the task
+    SHARED_MEMORY_SHARE = 0.25
+    def __init__(self, app, exporter, exportType):
+        """
+        Constructor
+        @param app: the application
+        @param exporter: the exporter running the task
+        @param exportType: the export type
+        """
+        self.app = app
+        self.exporter = exporter
+        self.exportType = exportType
+        if exportType in ("html_preview", "html_previewWX") and exporter is not None:
+            global previewType
+            previewType = exportType
+        self.options = Options.get(self.app.getGlobalConfig())
+        self.cache = getRenderCache(self.app, self.options)
+        self.disk = getDiskCache(self.app, exporter, self.options)
+        self.loaded = False
+        # the file exports share a style sheet, written once per page: the
+        # exported page must be known for html_multi (see getExportedPage),
+        # the inline styles are used otherwise
+        self.useClasses = self.options.cssClasses and (exportType == "html_single"
+            or (exportType == "html_multi" and hasattr(exporter, "wikiWord")))
+        self.styledPages = set()
+        # the keys of the blocks met during the task, the rendered blocks
+        # kept for their duplicates and what the duplicates saved
+        self.seenKeys = set()
+        self.shared = OrderedDict()
+        self.sharedSize = 0
+        self.sharedMaxSize = int((self.options.cacheMemory << 20) * self.SHARED_MEMORY_SHARE)
+        self.blocks = 0
+        # number of the blocks of the task sent to the background renderer
+        self.asyncBlocks = 0
+        self.duplicates = 0
+        self.duplicateBytes = 0
+        self.stats = None
+        if self.options.stats:
+            self.stats = renderStatistics
+            self.stats.count("tasks")
+        # insertions rendered ahead of the calls to createContent()
+        self.results = OrderedDict()
+        self.pending = None
+        if exportType in ("html_multi", "html_single"):
+            self.pending = self.iterPageInsertions(exporter)
+    def iterPageInsertions(self, exporter):
+        """
+        Yield the insertions of all the pages to export, page after page
+        """
+        wikiDocument = getattr(exporter, "wikiDocument", None)
+        wordList = getattr(exporter, "wordList", None)
+        if wikiDocument is None or not wordList:
+            return
+        for word in wordList:
+            try:
+                text = wikiDocument.getWikiPage(word).getLiveText()
+            except Exception:
+                continue
+            for insToken in findInsertions(text, word):
+                yield insToken
+    def getPageName(self, insToken):
+        """
+        Return the name of the page of an insertion or None if unknown
+        """
+        return getattr(insToken, "word", None) or self.getExportedPage()
+    def getExportedPage(self):
+        """
+        Return the name of the page being exported or None if unknown
+        This is the only page name the style sheets and the cache keys
+        depend on, so that the blocks rendered ahead match the ones
+        asked for by the exporter
+        """
+        return getattr(self.exporter, "wikiWord", None)
+    def loadPygments(self):
+        """
+        Load Pygments at first rendering
+        """
+        if self.loaded:
+            return
+        import_Pygments(self.app)
+        registerDependentStuff()
+        self.loaded = True
+    def resolve(self, insToken):
+        """
+        Return the code, the options and the background style of an insertion
+        Raise InsertionError if the insertion is not valid
+        """
+        try:
+            code, options = parseInsertion(insToken.value, insToken.appendices)
+        except OptionError, e:
+            raise InsertionError(
+                u"<span style='color: #CC033C'>" \
+                u"prettyCode: <b>Invalid option format. (%s)</b> Use 'lang=C++;showLine=0;...'" \
+                u"</span>" % escapeHtml(unicode(e)))
+
+        if options is None:
+            raise InsertionError(
+                u"<span style='color: #CC033C'>" \
+                u"prettyCode: <b>Invalid format.</b> Use [:%s:///source code:::lang=C++;showLine=0;...///]" \
+                u"</span>" % INSERTION_TAG)
+
+        options = options.resolve(self.options)
+        if options.file:
+            directory = getCodeFilesDir(self.app, self.exporter)
+            try:
+                if directory is None:
+                    raise IOError("no wiki data directory")
+                code = readCodeFile(directory, options.file)
+            except (IOError, OSError, ValueError):
+                raise InsertionError(
+                    u"<span style='color: #CC033C'>" \
+                    u"prettyCode: <b>Cannot read the file '%s'</b>" \
+                    u"</span>" % escapeHtml(options.file))
+        if options.lang.strip().lower() == AUTO_LANG:
+            lang = detectLanguage(code, self.app)
+            if lang is None:
+                lang = self.options.lang
+                if lang.strip().lower() == AUTO_LANG:
+                    lang = DEFAULT_LANG
+            options = options._replace(lang=lang)
+        bkg = self.options.bkgsLower.get(options.bkg.lower(), "").replace("'", '"')
+        return code, options, bkg
+    def getLexer(self, lang):
+        """
+        Return the lexer of a language
+        Raise InsertionError if the language is unknown
+        """
+        try:
+            return getLexer(lang, self.app)
+        except:
+            raise InsertionError(
+                u"<span style='color: #CC033C'>" \
+                u"prettyCode: <b>Invalid language name '%s'" \
+                u"</span>" % (lang))
+    def getFormatter(self, options):
+        """
+        Return the formatter for the options and the export type
+        """
+        if self.exportType == "html_previewWX":
+            # wx.html needs font, b, i instead of styled spans
+            return getWXFormatter(options.showLN, options.startLine, self.options.compactHtml)
+        return getFormatter(options.showLN, options.startLine, options.hlLines,
+            not self.useClasses, self.options.compactHtml)
+    def makeKey(self, code, options, bkg):
+        """
+        Return the render cache key of a block
+        """
+        exportType = self.exportType
+        if self.useClasses:
+            exportType += "/classes"
+        if self.options.compactHtml:
+            exportType += "/compact"
+        return RenderCache.makeKey(code, options, bkg, exportType)
+    def writeStyleSheet(self, out):
+        """
+        Write the style sheet of the CSS classes before the first block
+        of each page, or of the task for html_single
+        """
+        if self.exportType == "html_single":
+            page = True
+        else:
+            page = self.getExportedPage()
+        if page in self.styledPages:
+            return
+        if page is not None:
+            self.styledPages.add(page)
+        out.write(getStyleSheet(self.options.compactHtml))
+    def render(self, code, options, bkg, page=None):
+        """
+        Highlight a block
+        Return a TimedOutBlock if the time limit was reached
+        Raise InsertionError if the block cannot be rendered
+        """
+        out = ListWriter()
+        if not self.writeBlock(code, options, bkg, out, page):
+            return TimedOutBlock(out.getvalue())
+        return out.getvalue()
+    def writeBlock(self, code, options, bkg, out, page=None):
+        """
+        Highlight a block into the file-like object out: the tokens of
+        the lexer go through the formatter, which writes to out line
+        after line
+        Return False if the time limit was reached and the block was
+        written as plain text
+        Raise InsertionError if the block cannot be rendered, nothing is
+        written then
+        @param page: the name of the page of the block, for the statistics
+        """
+        start = time.time()
+        stats = self.stats
+        self.loadPygments()
+        lexer = self.getLexer(options.lang)
+        formatter = self.getFormatter(options)
+        if stats is not None:
+            lexStart = time.time()
+            stats.addTime("lexer", lexStart - start)
+        if self.isOverLimits(code, options):
+            if stats is not None:
+                stats.count("plain")
+            self.writePlain(code, options, bkg, out)
+            return True
+        deadline = None
+        if options.timeLimit > 0:
+            # the output is kept until the block is complete in case the
+            # time limit is reached, so only the blocks without a time
+            # limit are streamed; loading Pygments and the lexer does not
+            # count
+            deadline = time.time() + options.timeLimit / 1000.0
+            target = out
+            out = ListWriter()
+        try:
+            tokens = None
+            if self.exportType in ("html_preview", "html_previewWX") and self.options.incremental:
+                tokens = incrementalHighlighter.tokenize(lexer, code, deadline)
+            if tokens is None:
+                tokens = tokenCache.tokenize(lexer, code)
+            if stats is not None:
+                # the incremental lexing is already done
+                preLexed = time.time() - lexStart
+                timer = TokenTimer(preLexed)
+                tokens = timer.wrap(tokens)
+            if deadline is not None:
+                tokens = limitTime(tokens, deadline)
+            if bkg:
+                out.write(u'<pre style="%s">' % bkg)
+            formatStart = time.time()
+            formatter.format(tokens, out)
+            formatEnd = time.time()
+            if bkg:
+                out.write(u"</pre>")
+        except RenderTimeout:
+            if stats is not None:
+                stats.count("plain")
+            self.writePlain(code, options, bkg, target)
+            return False
+        if options.timeLimit > 0:
+            for part in out.parts:
+                target.write(part)
+        recordTiming("first render", start)
+        noteRenderTime(code, time.time() - start)
+        if stats is not None:
+            stats.addTime("tokenize", timer.elapsed)
+            stats.addTime("format", formatEnd - formatStart - (timer.elapsed - preLexed))
+            stats.addBlock(time.time() - start, len(code), options.lang, self.exportType, page)
+        return True
+    def isAsync(self, code, options):
+        """
+        Return True if the block is to be rendered in the background
+        """
+        return self.exportType in ("html_preview", "html_previewWX") \
+            and self.options.asyncPreview \
+            and len(code) >= ASYNC_MIN_SIZE \
+            and not self.isOverLimits(code, options)
+    def isOverLimits(self, code, options):
+        """
+        Return True if the block is too large to be highlighted
+        """
+        if options.maxSize > 0 and len(code) > options.maxSize:
+            return True
+        if options.maxLines <= 0:
+            return False
+        # the line ends around the code of the insertion are not lines
+        code = code.strip(u"\r\n")
+        return bool(code) and code.count(u"\n") + 1 > options.maxLines
+    def writePlain(self, code, options, bkg, out):
+        """
+        Write a block as plain text, with the background and the line numbers
+        """
+        text = escapeHtml(code.replace(u"\r\n", u"\n").replace(u"\r", u"\n").strip())
+        if bkg:
+            out.write(u'<pre style="%s">' % bkg)
+        out.write(u'<div class="source"><pre>')
+        if options.showLN:
+            lines = text.split(u"\n")
+            numberFormat = u"%%%dd " % len(str(len(lines) + options.startLine - 1))
+            for lineno, line in enumerate(lines):
+                out.write(numberFormat % (lineno + options.startLine))
+                out.write(line)
+                out.write(u"\n")
+        else:
+            out.write(text)
+            out.write(u"\n")
+        out.write(u"</pre></div>\n")
+        if bkg:
+            out.write(u"</pre>")
+    def finish(self, result, bkg):
+        """
+        Add the background to a highlighted block
+        """
+        if bkg:
+            start = time.time()
+            result = '<pre style="%s">%s</pre>' % (bkg, result)
+            if self.stats is not None:
+                self.stats.addTime("background", time.time() - start)
+        return result
+    def renderBatch(self, insTokens):
+        """
+        Render a set of insertions at once and keep the results for the
+        following calls to getContent()
+        Large blocks are sent to the process pool if the option is set
+        Return the number of rendered blocks
+        """
+        self.loadPygments()
+        blocks = []
+        keys = set()
+        for insToken in insTokens:
+            try:
+                code, options, bkg = self.resolve(insToken)
+                page = self.getPageName(insToken)
+                key = self.makeKey(code, options, bkg)
+                if key in keys or key in self.results or key in self.shared or key in self.cache.entries:
+                    continue
+                if self.disk is not None:
+                    result = self.disk.get(key)
+                    if result is not None:
+                        self.results[key] = result
+                        continue
+                self.getLexer(options.lang)
+            except InsertionError:
+                continue
+            keys.add(key)
+            blocks.append((key, code, options, bkg, page))
+        highlighted = {}
+        if self.options.parallel:
+            jobs = [(blockKey, (blockCode, blockOptions.lang.encode("utf-8", "ignore").lower(),
+                        bool(blockOptions.showLN), blockOptions.startLine, tuple(blockOptions.hlLines),
+                        not self.useClasses, self.options.compactHtml))
+                    for blockKey, blockCode, blockOptions, blockBkg, blockPage in blocks
+                    if len(blockCode) >= self.options.parallelMinSize
+                        and not self.isOverLimits(blockCode, blockOptions)]
+            if len(jobs) > 1:
+                start = time.time()
+                results = highlightInPool([job for jobKey, job in jobs])
+                if results is not None:
+                    highlighted = dict(zip([jobKey for jobKey, job in jobs], results))
+                    if self.stats is not None:
+                        poolTime = time.time() - start
+                        self.stats.addTime("pool", poolTime)
+        for key, code, options, bkg, page in blocks:
+            result = highlighted.get(key)
+            if result is None:
+                result = self.render(code, options, bkg, page)
+            else:
+                result = self.finish(result, bkg)
+                if self.stats is not None:
+                    # the time of a block in the pool is not known, the mean is taken
+                    self.stats.addBlock(poolTime / len(highlighted), len(code),
+                        options.lang, self.exportType, page)
+            if isinstance(result, TimedOutBlock):
+                noteTimedOut(key)
+            elif self.disk is not None:
+                self.disk.put(key, result)
+            self.results[key] = result
+        # drop the blocks the exporter did not ask for
+        while len(self.results) > 4 * self.BATCH_SIZE:
+            self.results.popitem(last=False)
+        return len(blocks)
+    def takeResult(self, key):
+        """
+        Return a block rendered ahead and forget it, or None
+        The blocks rendered ahead of it were not asked for by the exporter,
+        they are dropped, so that the held results count only the blocks
+        still to be consumed
+        """
+        if key not in self.results:
+            return None
+        while True:
+            resultKey, result = self.results.popitem(last=False)
+            if resultKey == key:
+                return result
+    def renderPending(self):
+        """
+        Render the next batch of insertions of the pages to export
+        """
+        if self.pending is None:
+            return
+        batch = list(itertools.islice(self.pending, self.BATCH_SIZE))
+        if not batch:
+            self.pending = None
+            return
+        self.renderBatch(batch)
+    def getContent(self, insToken):
+        """
+        Return the HTML code of an insertion
+        """
+        out = ListWriter()
+        self.writeContent(insToken, out)
+        return out.getvalue()
+    def writeContent(self, insToken, out, stream=False):
+        """
+        Write the HTML code of an insertion to the file-like object out
+        @param stream: True to write the blocks larger than STREAM_MIN_SIZE
+        to out while they are highlighted, they are not cached then
+        """
+        stats = self.stats
+        try:
+            if stats is not None:
+                start = time.time()
+            code, options, bkg = self.resolve(insToken)
+            if stats is not None:
+                stats.addTime("options", time.time() - start)
+            page = self.getPageName(insToken)
+            key = self.makeKey(code, options, bkg)
+            self.blocks += 1
+            duplicate = key in self.seenKeys
+            self.seenKeys.add(key)
+            result = self.getShared(key)
+            if result is None:
+                result = self.cache.get(key)
+                if stats is not None:
+                    stats.count("cacheMisses" if result is None else "cacheHits")
+            if result is None and self.disk is not None:
+                result = self.disk.get(key)
+                if stats is not None and result is not None:
+                    stats.count("diskHits")
+            if result is None:
+                if len(self.results) < self.BATCH_SIZE // 2:
+                    self.renderPending()
+                result = self.takeResult(key)
+            if result is None and backgroundRenderer is not None:
+                result = backgroundRenderer.pop(key)
+            if result is None and isTimedOut(key):
+                if stats is not None:
+                    stats.count("plain")
+                self.writePlain(code, options, bkg, out)
+                return
+            if result is None and self.isAsync(code, options):
+                # the lexer is checked at once to report an invalid language
+                self.getLexer(options.lang)
+                # a block being rendered in the background is not waited
+                # for, the preview is refreshed once it is done
+                self.asyncBlocks += 1
+                if getBackgroundRenderer(self.app).submit(key, code, options, bkg, self.exportType,
+                        slot=(page, self.asyncBlocks)):
+                    self.writePlain(code, options, bkg, out)
+                    return
+            if result is None and backgroundRenderer is not None \
+                    and backgroundRenderer.wait(key):
+                result = backgroundRenderer.pop(key) or self.cache.get(key)
+            if result is None:
+                if stream and len(code) >= STREAM_MIN_SIZE:
+                    if self.useClasses:
+                        self.writeStyleSheet(out)
+                    if not self.writeBlock(code, options, bkg, out, page):
+                        noteTimedOut(key)
+                    return
+                result = self.render(code, options, bkg, page)
+                if isinstance(result, TimedOutBlock):
+                    noteTimedOut(key)
+                elif self.disk is not None:
+                    self.disk.put(key, result)
+        except InsertionError, e:
+            if stats is not None:
+                stats.count("errors")
+            out.write(e.html)
+            return
+        if not isinstance(result, TimedOutBlock):
+            self.share(key, self.cache.put(key, result) or CacheEntry(result))
+        if duplicate:
+            self.duplicates += 1
+            self.duplicateBytes += len(result)
+        if self.useClasses:
+            self.writeStyleSheet(out)
+        out.write(result)
+    def share(self, key, entry):
+        """
+        Keep a rendered block for its duplicates in the task, the least
+        recently used blocks are dropped above sharedMaxSize bytes
+        @param entry: the CacheEntry of the block, the one of the render
+        cache if it is kept there
+        """
+        previous = self.shared.pop(key, None)
+        if previous is not None:
+            self.sharedSize -= previous.size
+        self.shared[key] = entry
+        self.sharedSize += entry.size
+        while self.sharedSize > self.sharedMaxSize and self.shared:
+            self.sharedSize -= self.shared.popitem(last=False)[1].size
+    def getShared(self, key):
+        """
+        Return a rendered block kept for the duplicates of the task or None
+        """
+        entry = self.shared.get(key)
+        if entry is None:
+            return None
+        return entry.getResult()
+    def getReport(self):
+        """
+        Return the number of blocks of the task, the number of duplicate
+        blocks which were not rendered again and the size of their HTML code
+        """
+        return {
+            "blocks": self.blocks,
+            "duplicates": self.duplicates,
+            "duplicateBytes": self.duplicateBytes,
+            }
+
+class BackgroundRenderer(object):
     """
-    The option panel for the plugin
+    Renders the blocks of the preview on a worker thread, stores them in
+    the render cache and refreshes the preview when done
+    The finished blocks are also kept apart until the preview takes them,
+    so that a render cache too small for them does not make the preview
+    submit them again for ever
     """
-    def __init__(self, parent, optionsDlg, app):
+    # number of finished blocks kept for the preview
+    FINISHED_SIZE = 64
+    def __init__(self, app):
         """
         Constructor
+        @param app: the application
         """
-        global pygments
-        import_Pygments(app)
-        registerDependentStuff()
-        from .pygments.lexers import get_all_lexers #@UnresolvedImport
-        #
-        wx.Panel.__init__(self, parent)
         self.app = app
-        #
-        self.options = Options(self.app.getGlobalConfig())
-        #
-        langs = [unicode(lang_def[0], "utf-8", "ignore") for lang_def in get_all_lexers()]
-        langs.sort()
-        #
-        mainSizer = wx.BoxSizer(wx.VERTICAL)
-        #
-        box = wx.StaticBox(self, -1, _("Default options"))
-        boxSizer = wx.StaticBoxSizer(box, wx.VERTICAL)
-        gridSizer = wx.FlexGridSizer(cols=2, hgap=5, vgap=5)
-        lLang = wx.StaticText(self, -1, _("Language:"))
-        self.lang = wx.Choice(self, -1, choices = langs)
-        if not self.lang.SetStringSelection(self.options.lang):
-            self.lang.SetStringSelection(DEFAULT_LANG)
-        lBkg = wx.StaticText(self, -1, _("Background:"))
-        self.bkg = wx.Choice(self, -1, choices = [NO_BKG] + self.options.bkgs.keys())
-        if not self.bkg.SetStringSelection(self.options.bkg):
-            self.bkg.SetSelection(0)
-        self.lineNb = wx.CheckBox(self, -1, _("Show line numbers"))
-        self.lineNb.SetValue(self.options.showLN)
-        gridSizer.Add(lLang, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
-        gridSizer.Add(self.lang, 0, wx.EXPAND)
-        gridSizer.Add(lBkg, 0, wx.ALIGN_RIGHT|wx.ALIGN_CENTER_VERTICAL)
-        gridSizer.Add(self.bkg, 0, wx.EXPAND)
-        gridSizer.Add((10, 10))
-        gridSizer.Add(self.lineNb, 0, wx.EXPAND)
-        boxSizer.Add(gridSizer, -1, wx.ALL|wx.EXPAND, 5)
-        mainSizer.Add(boxSizer, 0, wx.ALL|wx.EXPAND, 5)
-        #
-        box = wx.StaticBox(self, -1, _("Backgrounds"))
-        boxSizer = wx.StaticBoxSizer(box, wx.VERTICAL)
-        gridSizer = wx.BoxSizer(wx.HORIZONTAL)
-        addBkg = wx.BitmapButton(self, -1, wx.ArtProvider.GetBitmap(wx.ART_NEW))
-        self.Bind(wx.EVT_BUTTON, self.OnAddBkg, addBkg)
-        delBkg = wx.BitmapButton(self, -1, wx.ArtProvider.GetBitmap(wx.ART_DELETE))
-        self.Bind(wx.EVT_BUTTON, self.OnDelBkg, delBkg)
-        gridSizer.Add((10, 10), 1, flag=wx.EXPAND)
-        gridSizer.Add(addBkg, 0, flag=wx.EXPAND)
-        gridSizer.Add(delBkg, 0, flag=wx.EXPAND)
-        self.lBkgs = DictEdit(self, wx.NewId(), 
-            choices = self.options.bkgs, listChoices = self.bkg, style=wx.LC_REPORT|wx.BORDER_NONE|wx.LC_SORT_ASCENDING)
-        boxSizer.Add(gridSizer, 0, wx.EXPAND, 5)
-        boxSizer.Add(self.lBkgs, 1, wx.ALL|wx.EXPAND, 5)
-        mainSizer.Add(boxSizer, 1, wx.ALL|wx.EXPAND, 5)
-        #
-        self.SetSizer(mainSizer)
-        self.Fit()
-    def OnAddBkg(self, event):
-        self.lBkgs.AddNewItem(BKG_NEW, BKG_TMPL)
-    def OnDelBkg(self, event):
-        self.lBkgs.DelSelection()
-    def setVisible(self, vis):
+        self.lock = threading.Lock()
+        # slot -> (key, code, options, bkg, exportType) of the queued blocks,
+        # a newer version of a block replaces the queued one
+        self.jobs = OrderedDict()
+        self.queued = threading.Condition(self.lock)
+        # the keys of the blocks queued or being rendered
+        self.pending = set()
+        # the keys of the blocks which could not be rendered in the background
+        self.failed = set()
+        # the keys of the blocks rendered in the background, if they are
+        # asked for again the result was lost and they are rendered at once
+        self.rendered = set()
+        # key -> CacheEntry of the finished blocks not taken yet, the one of
+        # the render cache if it keeps the block
+        self.finished = OrderedDict()
+        # the key of the block being rendered
+        self.current = None
+        self.done = threading.Condition(self.lock)
+        # True if the preview is to be refreshed once the queue is empty,
+        # and if a block was finished or failed since the last refresh
+        self.refresh = False
+        self.updated = False
+        self.thread = None
+    def submit(self, key, code, options, bkg, exportType, refresh=True, slot=None):
         """
-        Called when panel is shown or hidden. The actual wxWindow.Show()
-        function is called automatically.
-        
-        If a panel is visible and becomes invisible because another panel is
-        selected, the plugin can veto by returning False.
-        When becoming visible, the return value is ignored.
+        Queue a block for rendering
+        Return False if the block is to be rendered at once
+        @param refresh: True to refresh the preview once rendered
+        @param slot: the place of the block in the preview, the queued
+        block of the same slot is replaced, None for the key
         """
+        with self.lock:
+            if key in self.failed or key in self.rendered:
+                return False
+            self.refresh = self.refresh or refresh
+            if key in self.pending:
+                return True
+            if slot is None:
+                slot = key
+            previous = self.jobs.pop(slot, None)
+            if previous is not None:
+                self.pending.discard(previous[0])
+            self.jobs[slot] = (key, code, options, bkg, exportType)
+            self.pending.add(key)
+            self.queued.notify()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.setDaemon(True)
+                self.thread.start()
         return True
-    def checkOk(self):
+    def run(self):
         """
-        Called when "OK" is pressed in dialog. The plugin should check here if
-        all input values are valid. If not, it should return False, then the
-        Options dialog automatically shows this panel.
-        
-        There should be a visual indication about what is wrong (e.g. red
-        background in text field). Be sure to reset the visual indication
-        if field is valid again.
+        Worker thread loop
         """
-        return True
-    def handleOk(self):
+        while True:
+            with self.lock:
+                while not self.jobs:
+                    self.queued.wait()
+                key, code, options, bkg, exportType = self.jobs.popitem(last=False)[1]
+                self.current = key
+            entry = None
+            try:
+                task = ExportTask(self.app, None, exportType)
+                # the block may have been rendered since it was queued
+                if key not in task.cache.entries:
+                    result = task.render(code, options, bkg)
+                    if isinstance(result, TimedOutBlock):
+                        # the preview writes the block as plain text at once
+                        noteTimedOut(key)
+                        with self.lock:
+                            self.failed.add(key)
+                    else:
+                        entry = task.cache.put(key, result) or CacheEntry(result)
+                        if task.disk is not None:
+                            task.disk.put(key, result)
+            except Exception:
+                with self.lock:
+                    self.failed.add(key)
+            with self.lock:
+                self.updated = self.updated or entry is not None or key in self.failed
+                self.pending.discard(key)
+                self.current = None
+                if entry is not None:
+                    self.rendered.add(key)
+                    self.finished.pop(key, None)
+                    self.finished[key] = entry
+                    while len(self.finished) > self.FINISHED_SIZE:
+                        self.finished.popitem(last=False)
+                self.done.notifyAll()
+                refresh = self.refresh and self.updated and not self.jobs
+                if not self.jobs:
+                    self.refresh = False
+                    self.updated = False
+            if refresh:
+                wx.CallAfter(refreshPreview, self.app)
+    def pop(self, key):
         """
-        This is called if checkOk() returned True for all panels. Transfer here
-        all values from text fields, checkboxes, ... into the configuration
-        file.
+        Return the HTML code of a finished block and forget it, or None
         """
-        self.options.lang = self.lang.GetStringSelection()
-        self.options.bkg = self.bkg.GetStringSelection()
-        self.options.showLN = self.lineNb.GetValue()
-        self.options.bkgs = {}
-        for i in xrange(self.lBkgs.GetItemCount()):
-            self.options.bkgs[self.lBkgs.GetItemText(i).strip()] = self.lBkgs.GetItem(i, 1).GetText().strip()
-        self.options.save()
+        with self.lock:
+            entry = self.finished.pop(key, None)
+        if entry is None:
+            return None
+        return entry.getResult()
+    def wait(self, key):
+        """
+        Wait for the end of the rendering of a block if it is being rendered
+        Return True if the block was being rendered
+        """
+        with self.lock:
+            if self.current != key:
+                return False
+            while self.current == key:
+                self.done.wait()
+            return True
+    def reset(self):
+        """
+        Forget the failed and the finished blocks, called when the options change
+        """
+        with self.lock:
+            self.failed.clear()
+            self.rendered.clear()
+            self.finished.clear()
 
-######################################################################################
-# Insertion
-######################################################################################
-def describeInsertionKeys(ver, app):
+# the background renderer, created at first use
+backgroundRenderer = None
+
+def getBackgroundRenderer(app):
     """
-    API function for "InsertionByKey" plugins
-    Returns a sequence of tuples describing the supported
-    insertion keys. Each tuple has the form (insKey, exportTypes, handlerFactory)
-    where insKey is the insertion key handled, exportTypes is a sequence of
-    strings describing the supported export types and handlerFactory is
-    a factory function (normally a class) taking the wxApp object as
-    parameter and returning a handler object fulfilling the protocol
-    for "insertion by key" (see EqnHandler as example).
-    
-    This plugin uses the special export type "wikidpad_language" which is
-    not a real type like HTML export, but allows to return a string
-    which conforms to WikidPad wiki syntax and is postprocessed before
-    exporting.
-    Therefore this plugin is not bound to a specific export type.
+    Return the background renderer
+    """
+    global backgroundRenderer
+    if backgroundRenderer is None:
+        backgroundRenderer = BackgroundRenderer(app)
+    return backgroundRenderer
 
-    ver -- API version (can only be 1 currently)
-    app -- wxApp object
+def refreshPreview(app):
     """
-    return (
-            (INSERTION_TAG, ("html_single", "html_previewWX", "html_preview", "html_multi"), InsertionHandler),
-            )
+    Render again the preview of the current page
+    """
+    try:
+        presenter = app.GetTopWindow().getCurrentDocPagePresenter()
+        preview = presenter.getSubControl("preview")
+    except Exception:
+        return
+    if preview is None:
+        return
+    preview.outOfSync = True
+    refresh = getattr(preview, "refresh", None)
+    if refresh is not None:
+        refresh()
 
 class InsertionHandler(object):
     def __init__(self, app):
@@ -825,6 +3474,11 @@ class InsertionHandler(object):
         Constructor
         """
         self.app = app
+        self.task = None
+        # the task of the calls to createContent() out of taskStart() and taskEnd()
+        self.looseTask = None
+        # the report of the last export task, see ExportTask.getReport()
+        self.report = None
     def taskStart(self, exporter, exportType):
         """
         This is called before any call to createContent() during an
@@ -837,13 +3491,32 @@ class InsertionHandler(object):
         Calls to createContent() will only happen after a 
         call to taskStart() and before the call to taskEnd()
         """
-        pass
+        self.task = ExportTask(self.app, exporter, exportType)
+        self.looseTask = None
     def taskEnd(self):
         """
         Called after export task ended and after the last call to
         createContent().
         """
-        pass
+        if self.task is not None:
+            flushDiskCaches()
+            flushCodeIndexes()
+            self.report = self.task.getReport()
+            if self.task.stats is not None:
+                self.task.stats.count("duplicates", self.report["duplicates"])
+                self.task.stats.count("duplicateBytes", self.report["duplicateBytes"])
+                path = getStatsPath(self.app, self.task.options)
+                if path is not None:
+                    self.task.stats.dump(path)
+        self.task = None
+    def renderBatch(self, insTokens):
+        """
+        Render all the given insertions of the current export task in one
+        batch, the following calls to createContent() pick up the results
+        """
+        if self.task is None:
+            return 0
+        return self.task.renderBatch(insTokens)
     def createContent(self, exporter, exportType, insToken):
         """
         Handle an insertion and create the appropriate content.
@@ -864,138 +3537,476 @@ class InsertionHandler(object):
         For HtmlXmlExporter a unistring is returned with the HTML code
         to insert instead of the insertion.        
         """
-        options = Options(self.app.getGlobalConfig())
-        optionFound = False
-
-        def handleOption(name, value):
-            name = name.strip().lower()
-            value = value.strip()
-
-            if name == u"lang":
-                options.lang = value
-            elif name == u"showlines":
-                options.showLN = int(value) != 0
-            elif name == u"startline":
-                options.startLine = int(value)
-            elif name == u"hllines":
-                if value:
-                    options.hlLines = [int(x) for x in value.split(",")]
-                else:
-                    options.hlLines = []
-            elif name == u"bkg":
-                if value != u"default":
-                    options.bkg = value
-            else:
-                raise Exception("invalid option name: '%s'" % name)
+        return self.getTask(exporter, exportType).getContent(insToken)
+    def writeContent(self, exporter, exportType, insToken, out):
+        """
+        Same as createContent() but write the HTML code to the file-like
+        object out, so that large blocks are not built in memory (when
+        their time limit is 0, see ExportTask.writeBlock)
+        """
+        self.getTask(exporter, exportType).writeContent(insToken, out, True)
+    def getTask(self, exporter, exportType):
+        """
+        Return the current export task, or the task kept for the calls out
+        of taskStart() and taskEnd() with the same exporter, export type
+        and options
+        """
+        task = self.task
+        if task is not None and task.exportType == exportType:
+            return task
+        task = self.looseTask
+        if task is None or task.exporter is not exporter or task.exportType != exportType \
+                or task.options is not Options.get(self.app.getGlobalConfig()):
+            task = self.looseTask = ExportTask(self.app, exporter, exportType)
+        return task
 
+    def getExtraFeatures(self):
+        """
+        Returns a list of bytestrings describing additional features supported
+        by the plugin. Currently not specified further.
+        """
+        return ()
 
-        try:
-            code, soptions = insToken.value.rsplit(u":::", 1)
-            soptionArgs = soptions.split(u";")
-        except ValueError:
-            code = insToken.value
-            soptionArgs = []
+######################################################################################
+# Code block index
+######################################################################################
+INDEX_FILENAME = "PrettyCode.index.db"
 
+class CodeIndex(object):
+    """
+    SQLite index of the code blocks of a wiki: page, offset, language,
+    size, options and content digest of each block, with the rendering
+    time of the slow blocks
+    The pages are read one at a time, so that large wikis are not loaded
+    in memory
+    """
+    # number of pages indexed per transaction
+    COMMIT_PAGES = 200
+    def __init__(self, path):
+        """
+        Constructor
+        @param path: the path of the database
+        """
+        self.path = path
+        self.connection = None
+    def connect(self):
+        """
+        Return the connection to the database, create the tables at first use
+        """
+        if self.connection is None:
+            import sqlite3
+            connection = sqlite3.connect(self.path, timeout=10)
+            connection.executescript("""
+                CREATE TABLE IF NOT EXISTS pages (word TEXT PRIMARY KEY, modified REAL);
+                CREATE TABLE IF NOT EXISTS blocks (word TEXT, offset INTEGER, lang TEXT,
+                    size INTEGER, lines INTEGER, options TEXT, digest TEXT);
+                CREATE INDEX IF NOT EXISTS blocks_word ON blocks (word);
+                CREATE INDEX IF NOT EXISTS blocks_size ON blocks (size);
+                CREATE TABLE IF NOT EXISTS renderTimes (digest TEXT PRIMARY KEY, seconds REAL);
+                """)
+            self.connection = connection
+        return self.connection
+    @staticmethod
+    def describe(insToken):
+        """
+        Return (language or None for the default one, option string,
+        code) of an insertion
+        """
         try:
-            for setopt in soptionArgs:
-                try:
-                    name, value = setopt.split(u"=", 1)
-                except ValueError:
-                    name, value = setopt.split(u":", 1)
-                    
-                handleOption(name, value)
-                optionFound = True
-
-            for setopt in insToken.appendices:
+            code, options = parseInsertion(insToken.value, insToken.appendices)
+        except OptionError:
+            code, options = insToken.value, None
+        optionStrings = list(insToken.appendices)
+        if u":::" in insToken.value:
+            optionStrings.insert(0, insToken.value.rsplit(u":::", 1)[1])
+        if options is not None and options.file:
+            # the content of the file is not indexed
+            code = u""
+        return options and options.lang, u";".join(optionStrings), code
+    def indexPage(self, wikiDocument, word, modified=None, commit=True):
+        """
+        Index the blocks of a page, replacing its previous entries
+        @param modified: the modification time of the page
+        """
+        text = wikiDocument.getWikiPage(word).getLiveText()
+        rows = []
+        for insToken in findInsertions(text, word):
+            lang, optionString, code = self.describe(insToken)
+            rows.append((word, insToken.start, lang, len(code), code.count(u"\n") + 1, optionString,
+                hashlib.sha1(code.encode("utf-8", "replace")).hexdigest()))
+        connection = self.connect()
+        connection.execute("DELETE FROM blocks WHERE word = ?", (word,))
+        connection.executemany("INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        connection.execute("INSERT OR REPLACE INTO pages VALUES (?, ?)", (word, modified))
+        if commit:
+            connection.commit()
+    def removePage(self, word):
+        """
+        Drop the entries of a deleted page
+        """
+        connection = self.connect()
+        connection.execute("DELETE FROM blocks WHERE word = ?", (word,))
+        connection.execute("DELETE FROM pages WHERE word = ?", (word,))
+        connection.commit()
+    def renamePage(self, oldWord, newWord):
+        """
+        Move the entries of a renamed page
+        """
+        connection = self.connect()
+        connection.execute("DELETE FROM blocks WHERE word = ?", (newWord,))
+        connection.execute("DELETE FROM pages WHERE word = ?", (newWord,))
+        connection.execute("UPDATE blocks SET word = ? WHERE word = ?", (newWord, oldWord))
+        connection.execute("UPDATE pages SET word = ? WHERE word = ?", (newWord, oldWord))
+        connection.commit()
+    def update(self, wikiDocument, progress=None):
+        """
+        Index the pages modified since they were indexed and drop the
+        deleted pages
+        @param progress: function called with (pages done, pages), which
+            returns False to stop
+        Return the number of indexed pages
+        """
+        connection = self.connect()
+        words = wikiDocument.getAllDefinedWikiPageNames()
+        indexed = dict(connection.execute("SELECT word, modified FROM pages"))
+        count = 0
+        for i, word in enumerate(words):
+            modified = getPageModified(wikiDocument, word)
+            known = indexed.pop(word, -1)
+            if modified is None or modified != known:
                 try:
-                    name, value = setopt.split(u"=", 1)
-                except ValueError:
-                    name, value = setopt.split(u":", 1)
-                
-                handleOption(name, value)
-                optionFound = True
-            
-        except Exception, e:
-            return  \
-                u"<span style='color: #CC033C'>" \
-                u"prettyCode: <b>Invalid option format. (%s)</b> Use 'lang=C++;showLine=0;...'" \
-                u"</span>" % (str(e))        
+                    self.indexPage(wikiDocument, word, modified, False)
+                except Exception:
+                    continue
+                count += 1
+                if not count % self.COMMIT_PAGES:
+                    connection.commit()
+            if progress is not None and not i % 50 and progress(i, len(words)) is False:
+                connection.commit()
+                return count
+        # the pages left were deleted
+        for word in indexed:
+            connection.execute("DELETE FROM blocks WHERE word = ?", (word,))
+            connection.execute("DELETE FROM pages WHERE word = ?", (word,))
+        connection.commit()
+        return count
+    def saveRenderTimes(self, times):
+        """
+        Store the rendering times of blocks: code digest -> seconds
+        """
+        if not times:
+            return
+        connection = self.connect()
+        connection.executemany("INSERT OR REPLACE INTO renderTimes VALUES (?, ?)", times.items())
+        connection.commit()
+    def getLanguageUsage(self):
+        """
+        Return a list of (language, number of blocks, total size), the most
+        used first, the language is None for the default one
+        """
+        return self.connect().execute("SELECT lang, COUNT(*), SUM(size) FROM blocks "
+            "GROUP BY lower(lang) ORDER BY COUNT(*) DESC").fetchall()
+    def getLargestBlocks(self, count=10):
+        """
+        Return a list of (page, offset, language, size, lines) of the largest blocks
+        """
+        return self.connect().execute("SELECT word, offset, lang, size, lines FROM blocks "
+            "ORDER BY size DESC LIMIT ?", (count,)).fetchall()
+    def getSlowestBlocks(self, count=10):
+        """
+        Return a list of (page, offset, language, size, seconds) of the
+        slowest blocks rendered so far
+        """
+        return self.connect().execute("SELECT b.word, b.offset, b.lang, b.size, t.seconds "
+            "FROM blocks b JOIN renderTimes t ON b.digest = t.digest "
+            "ORDER BY t.seconds DESC LIMIT ?", (count,)).fetchall()
+    def getSummary(self):
+        """
+        Return (number of pages, number of blocks, total size of the blocks)
+        """
+        connection = self.connect()
+        pages = connection.execute("SELECT COUNT(DISTINCT word) FROM blocks").fetchone()[0]
+        blocks, size = connection.execute("SELECT COUNT(*), TOTAL(size) FROM blocks").fetchone()
+        return pages, blocks, int(size)
 
-        if not optionFound:
-            return \
-                u"<span style='color: #CC033C'>" \
-                u"prettyCode: <b>Invalid format.</b> Use [:%s:///source code:::lang=C++;showLine=0;...///]" \
-                u"</span>" % INSERTION_TAG
+def getPageModified(wikiDocument, word):
+    """
+    Return the modification time of a page or None if unknown
+    """
+    try:
+        return wikiDocument.getWikiPage(word).getTimestamps()[0]
+    except Exception:
+        return None
 
+# the indexes by database path
+codeIndexes = {}
+# the rendering times of the slow blocks not stored yet: code digest -> seconds
+slowBlocks = {}
+# minimal rendering time (in seconds) of the blocks noted in the indexes
+SLOW_BLOCK_TIME = 0.05
 
+def getCodeIndex(app, wikiDocument):
+    """
+    Return the code block index of a wiki
+    """
+    try:
+        dataDir = wikiDocument.getDataDir()
+    except Exception:
+        dataDir = getWikiDataDir(app, None)
+    path = os.path.join(dataDir, INDEX_FILENAME)
+    index = codeIndexes.get(path)
+    if index is None:
+        index = CodeIndex(path)
+        codeIndexes[path] = index
+    return index
 
-        import_Pygments(self.app)
-        registerDependentStuff()
-        from .pygments import highlight #@UnresolvedImport
-        from .pygments.lexers import get_lexer_by_name #@UnresolvedImport
-        from .pygments.formatters import HtmlFormatter #@UnresolvedImport
-        
+def noteRenderTime(code, seconds):
+    """
+    Note the rendering time of a slow block for the indexes
+    """
+    if codeIndexes and seconds >= SLOW_BLOCK_TIME:
+        slowBlocks[hashlib.sha1(code.encode("utf-8", "replace")).hexdigest()] = seconds
+
+def flushCodeIndexes():
+    """
+    Store the noted rendering times in the indexes
+    """
+    if not slowBlocks:
+        return
+    times = dict(slowBlocks)
+    slowBlocks.clear()
+    for index in codeIndexes.values():
         try:
-            lexer = get_lexer_by_name(options.lang.encode("utf-8", "ignore").lower(), stripall=True, encoding = None)
-        except:
-            return  \
-                u"<span style='color: #CC033C'>" \
-                u"prettyCode: <b>Invalid language name '%s'" \
-                u"</span>" % (options.lang)
-        if options.showLN:
-            showLN = "inline"
-        else:
-            showLN = False  
-        formatter = HtmlFormatter(
-            cssclass="source", noclasses = True, encoding = None,
-            linenos=showLN, linenostart = options.startLine, hl_lines = options.hlLines,
-            )
-        result = highlight(code, lexer, formatter)
-        bkgs = dict(zip([x.lower() for x in options.bkgs.keys()], options.bkgs.values()))
-        bkg = bkgs.get(options.bkg.lower(), "").replace("'", '"')
-        if bkg:
-            result = '<pre style="%s">%s</pre>' % (bkg, result)
-        html = result.encode("utf8", 'replace')
-        if exportType == "html_previewWX":
-            # we need to convert the HTML spans to font, b, i, ..
-            parser = WXHtmlConverter()
-            parser.feed(html)
-            parser.close()
-            result = unicode(parser.out.getvalue(), 'utf8', 'replace')
-        return result
+            index.saveRenderTimes(times)
+        except Exception:
+            pass
 
-    def getExtraFeatures(self):
-        """
-        Returns a list of bytestrings describing additional features supported
-        by the plugin. Currently not specified further.
-        """
-        return ()
+def formatCodeReport(index, count=10):
+    """
+    Return the report of the code blocks of a wiki as text
+    """
+    pages, blocks, size = index.getSummary()
+    lines = [_(u"%d code blocks (%.1f MB) in %d pages") % (blocks, size / 1048576.0, pages), u""]
+    lines.append(_(u"Languages:"))
+    for lang, number, langSize in index.getLanguageUsage():
+        lines.append(u"    %-20s %6d blocks %10d characters" % (lang or _(u"(default)"), number, langSize))
+    lines.append(u"")
+    lines.append(_(u"Largest blocks:"))
+    for word, offset, lang, blockSize, blockLines in index.getLargestBlocks(count):
+        lines.append(u"    %s @%d (%s): %d characters, %d lines" % \
+            (word, offset, lang or _(u"(default)"), blockSize, blockLines))
+    lines.append(u"")
+    lines.append(_(u"Slowest blocks:"))
+    for word, offset, lang, blockSize, seconds in index.getSlowestBlocks(count):
+        lines.append(u"    %s @%d (%s): %d characters, %.0f ms" % \
+            (word, offset, lang or _(u"(default)"), blockSize, seconds * 1000))
+    return u"\n".join(lines)
+
+def warmCacheFromIndex(app, wikiDocument, index, count=10):
+    """
+    Queue the blocks of the pages holding the largest and the slowest
+    blocks for rendering in the background
+    """
+    words = []
+    for row in index.getSlowestBlocks(count) + index.getLargestBlocks(count):
+        if row[0] not in words:
+            words.append(row[0])
+    for word in words:
+        try:
+            prefetchPage(app, wikiDocument, word)
+        except Exception:
+            pass
+    return len(words)
+
+######################################################################################
+# Hooks
+######################################################################################
+def prefetchPage(app, wikiDocument, word):
+    """
+    Queue the blocks of a page not in the render cache for rendering in
+    the background, for the export type of the last preview
+    """
+    text = wikiDocument.getWikiPage(word).getLiveText()
+    task = ExportTask(app, None, previewType)
+    renderer = getBackgroundRenderer(app)
+    for insToken in findInsertions(text, word):
+        try:
+            code, options, bkg = task.resolve(insToken)
+        except InsertionError:
+            continue
+        key = task.makeKey(code, options, bkg)
+        if key not in task.cache.entries:
+            renderer.submit(key, code, options, bkg, task.exportType, False)
+
+def openedWikiWord(docPagePresenter, wikiWord):
+    """
+    Hook called after a wiki page is opened in the editor
+    The blocks of the page are highlighted in the background if the
+    option is set, so that they are ready when the preview asks for them
+    """
+    app = wx.GetApp()
+    try:
+        if not Options.get(app.getGlobalConfig()).prefetch:
+            return
+        prefetchPage(app, docPagePresenter.getWikiDocument(), wikiWord)
+    except Exception:
+        pass
+
+def savedWikiWord(docPagePresenter, wikiWord):
+    """
+    Hook called after a wiki page is saved, its blocks are indexed if
+    the option is set
+    """
+    app = wx.GetApp()
+    try:
+        if not Options.get(app.getGlobalConfig()).codeIndex:
+            return
+        wikiDocument = docPagePresenter.getWikiDocument()
+        getCodeIndex(app, wikiDocument).indexPage(wikiDocument, wikiWord,
+            getPageModified(wikiDocument, wikiWord))
+    except Exception:
+        pass
+
+def renamedWikiWord(docPagePresenter, oldWord, newWord):
+    """
+    Hook called after a wiki page is renamed
+    """
+    app = wx.GetApp()
+    try:
+        if not Options.get(app.getGlobalConfig()).codeIndex:
+            return
+        getCodeIndex(app, docPagePresenter.getWikiDocument()).renamePage(oldWord, newWord)
+    except Exception:
+        pass
+
+def deletedWikiWord(docPagePresenter, wikiWord):
+    """
+    Hook called after a wiki page is deleted
+    """
+    app = wx.GetApp()
+    try:
+        if not Options.get(app.getGlobalConfig()).codeIndex:
+            return
+        getCodeIndex(app, docPagePresenter.getWikiDocument()).removePage(wikiWord)
+    except Exception:
+        pass
 
 ######################################################################################
 # src highlighting
 ######################################################################################
+# the line ends converted to "\n"
+NEWLINE_RE = re.compile(u"\r\n?")
+
 def insertCode(wiki, text, replace=False):
     """
     Insert some code into the wiki
+    The large texts can be stored in a code file, they are inserted in
+    chunks with a progress dialog otherwise
     @param wiki: the wiki
     @param text: the text to insert
+    @param replace: True to replace the selection
     """
     # Get the clipboard contents ?
-    options = Options(wiki.getConfig())
-    text = u"[:%s:///\n" % INSERTION_TAG + text
-    if not text.endswith("\n"):
-        text += "\n"
-    text += u":::lang=%s;showLines=%d;startLine=%d;hlLines=%s;Bkg=default///]\n" % \
+    options = Options.get(wiki.getConfig())
+    text = NEWLINE_RE.sub(u"\n", text)
+    fileName = None
+    if len(text) >= LARGE_PASTE_SIZE:
+        answer = wx.MessageBox(
+            _(u"The code is large (%.1f MB). Store it in a file of the wiki instead of the page?") % \
+                (len(text) / 1048576.0),
+            _(u"Paste code"), wx.YES_NO | wx.CANCEL | wx.ICON_QUESTION, wiki)
+        if answer == wx.CANCEL:
+            return
+        if answer == wx.YES:
+            fileName = saveCodeFile(wiki, text)
+            if fileName is None:
+                return
+    parts = [u"[:%s:///\n" % INSERTION_TAG]
+    if fileName is None:
+        parts.append(text)
+        if not text.endswith(u"\n"):
+            parts.append(u"\n")
+    parts.append(u":::lang=%s;showLines=%d;startLine=%d;hlLines=%s;Bkg=default" % \
         (
          options.lang, 
          int(options.showLN), 
          options.startLine, 
          ",".join([str(x)for x in options.hlLines],
-        ))
-    if replace:
-        wiki.getActiveEditor().ReplaceSelection(text)
+        )))
+    if fileName is not None:
+        parts.append(u";file=%s" % fileName)
+    parts.append(u"///]\n")
+    text = u"".join(parts)
+    editor = wiki.getActiveEditor()
+    if len(text) >= LARGE_PASTE_SIZE:
+        insertChunks(wiki, editor, text, replace)
+    elif replace:
+        editor.ReplaceSelection(text)
     else:
-        wiki.getActiveEditor().AddText(text)
+        editor.AddText(text)
+
+def insertChunks(wiki, editor, text, replace):
+    """
+    Insert a large text into the editor in chunks of PASTE_CHUNK_SIZE,
+    with a progress dialog, as one undo action
+    Return False if the user cancelled, the insertion is undone then
+    """
+    dialog = wx.ProgressDialog(_(u"Paste code"), _(u"Inserting the code..."), len(text), wiki,
+        wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME | wx.PD_REMAINING_TIME)
+    cancelled = False
+    editor.BeginUndoAction()
+    try:
+        if replace:
+            editor.ReplaceSelection(u"")
+        pos = 0
+        while pos < len(text):
+            end = pos + PASTE_CHUNK_SIZE
+            # do not split a surrogate pair
+            if end < len(text) and u"\ud800" <= text[end - 1] <= u"\udbff":
+                end += 1
+            editor.AddText(text[pos:end])
+            pos = end
+            result = dialog.Update(min(pos, len(text)))
+            # (continue, skip) with the recent versions of wxPython
+            if isinstance(result, tuple):
+                result = result[0]
+            if not result:
+                cancelled = True
+                break
+    finally:
+        editor.EndUndoAction()
+        dialog.Destroy()
+    if cancelled:
+        editor.Undo()
+    return not cancelled
+
+def saveCodeFile(wiki, text):
+    """
+    Save a code in a new file of the code files directory
+    Return the name of the file or None on error
+    """
+    directory = getCodeFilesDir(wx.GetApp(), None)
+    if directory is None:
+        return None
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = time.strftime("code-%Y%m%d-%H%M%S")
+        fileName = name + ".txt"
+        count = 1
+        while os.path.exists(os.path.join(directory, fileName)):
+            count += 1
+            fileName = "%s-%d.txt" % (name, count)
+        f = open(os.path.join(directory, fileName), "wb")
+        try:
+            f.write(text.encode("utf-8"))
+        finally:
+            f.close()
+    except (IOError, OSError), e:
+        wx.MessageBox(_(u"Cannot save the code: %s") % e, _(u"Paste code"),
+            wx.OK | wx.ICON_ERROR, wiki)
+        return None
+    return unicode(fileName)
 
 def pasteCode(wiki, evt):
     """
@@ -1013,6 +4024,42 @@ def pasteCode(wiki, evt):
             text += data.GetText()
     insertCode(wiki, text)
 
+def showCodeReport(wiki, evt):
+    """
+    Update the code block index of the wiki, show its report and
+    optionally highlight the largest and slowest blocks in the background
+    @param wiki: the wiki
+    @param evt: the triggering event
+    """
+    app = wx.GetApp()
+    wikiDocument = wiki.getWikiDocument()
+    try:
+        index = getCodeIndex(app, wikiDocument)
+        dialog = wx.ProgressDialog(_(u"Code blocks"), _(u"Indexing the code blocks..."), 100, wiki,
+            wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME)
+        def progress(done, total):
+            result = dialog.Update(done * 100 // max(1, total))
+            if isinstance(result, tuple):
+                result = result[0]
+            return result
+        try:
+            index.update(wikiDocument, progress)
+        finally:
+            dialog.Destroy()
+        flushCodeIndexes()
+        report = formatCodeReport(index)
+    except Exception, e:
+        wx.MessageBox(_(u"Cannot index the code blocks: %s") % e, _(u"Code blocks"),
+            wx.OK | wx.ICON_ERROR, wiki)
+        return
+    from wx.lib.dialogs import ScrolledMessageDialog
+    dialog = ScrolledMessageDialog(wiki, report, _(u"Code blocks"))
+    dialog.ShowModal()
+    dialog.Destroy()
+    if wx.MessageBox(_(u"Highlight the pages with the largest and slowest blocks now, so that they are cached?"),
+            _(u"Code blocks"), wx.YES_NO | wx.ICON_QUESTION, wiki) == wx.YES:
+        warmCacheFromIndex(app, wikiDocument, index)
+
 def addCodeTags(wiki, evt):
     """
     Add the plugin tags to the current selection
@@ -1022,4 +4069,6 @@ def addCodeTags(wiki, evt):
     text = wiki.getActiveEditor().GetSelectedText()
     insertCode(wiki, text, True)
 
+recordTiming("module load", _loadStart)
+
 ######################################################################################
@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+######################################################################################
+# Benchmark of the insertion rendering of the prettyCode plugin
+#
+# Runs the plugin outside of WikidPad, without wxPython, with stub application,
+# configuration, exporter, insertion token and wx objects, and renders a corpus of
+# code blocks with each export type. Each export type is run in its own process.
+#
+# Usage:
+#    python benchmark.py [--types html_preview,html_multi] [--scale 1] [--repeat 3]
+#                        [--cache-size 0] [--time-limit 0] [--parallel] [--compact-html]
+#                        [--in-process] [--output results.json]
+#
+# The results are written as JSON: for each export type, the number of blocks and
+# bytes rendered, the throughput (blocks/s, MB/s), the p50/p99 latency of a call to
+# createContent() and the peak memory of its process.
+######################################################################################
+import os, sys, imp, time, json, types, shutil, tempfile, platform, argparse, subprocess, __builtin__
+
+EXPORT_TYPES = ("html_preview", "html_previewWX", "html_multi", "html_single")
+
+# one small and realistic block per language
+SNIPPETS = {
+    u"Python": u'''import os
+
+class Walker(object):
+    """Walk a tree of files"""
+    def __init__(self, root, pattern="*.py"):
+        self.root = root
+        self.pattern = pattern
+    def __iter__(self):
+        for path, dirs, files in os.walk(self.root):
+            for name in files:
+                if name.endswith(".py"):
+                    yield os.path.join(path, name)  # 42
+''',
+    u"C": u'''#include <stdio.h>
+#include <string.h>
+
+/* count the words of a line */
+static int count_words(const char *line)
+{
+    int n = 0, in_word = 0;
+    for (; *line; line++) {
+        if (*line == ' ' || *line == '\\t')
+            in_word = 0;
+        else if (!in_word) {
+            in_word = 1;
+            n++;
+        }
+    }
+    return n;
+}
+''',
+    u"C++": u'''#include <vector>
+#include <string>
+
+template <typename T>
+class Stack {
+public:
+    void push(const T& value) { items_.push_back(value); }
+    T pop() {
+        T value = items_.back();
+        items_.pop_back();
+        return value;
+    }
+    bool empty() const { return items_.empty(); }
+private:
+    std::vector<T> items_;
+};
+''',
+    u"Java": u'''package org.example;
+
+import java.util.HashMap;
+import java.util.Map;
+
+public class WordCount {
+    public static Map<String, Integer> count(String text) {
+        Map<String, Integer> counts = new HashMap<String, Integer>();
+        for (String word : text.split("\\\\s+")) {
+            Integer n = counts.get(word);
+            counts.put(word, n == null ? 1 : n + 1);
+        }
+        return counts;
+    }
+}
+''',
+    u"JavaScript": u'''function debounce(fn, delay) {
+    var timer = null;
+    return function () {
+        var args = arguments, self = this;
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            fn.apply(self, args);
+        }, delay);
+    };
+}
+window.onresize = debounce(function () { console.log("resized"); }, 250);
+''',
+    u"HTML": u'''<!DOCTYPE html>
+<html>
+  <head>
+    <title>Example</title>
+    <link rel="stylesheet" href="style.css">
+  </head>
+  <body>
+    <h1 class="title">Hello</h1>
+    <p>Some <b>bold</b> and <i>italic</i> text &amp; an <a href="#top">anchor</a>.</p>
+  </body>
+</html>
+''',
+    u"XML": u'''<?xml version="1.0" encoding="UTF-8"?>
+<project name="example" default="build">
+  <property name="src" value="src"/>
+  <!-- compile the sources -->
+  <target name="build">
+    <javac srcdir="${src}" destdir="build" debug="true"/>
+  </target>
+</project>
+''',
+    u"SQL": u'''SELECT p.name, COUNT(o.id) AS orders, SUM(o.total) AS revenue
+FROM products p
+LEFT JOIN orders o ON o.product_id = p.id
+WHERE o.created >= '2008-01-01'
+GROUP BY p.name
+HAVING COUNT(o.id) > 10
+ORDER BY revenue DESC;
+''',
+    u"Bash": u'''#!/bin/bash
+set -e
+for f in "$@"; do
+    if [ -f "$f" ]; then
+        lines=$(wc -l < "$f")
+        echo "$f: $lines lines"
+    else
+        echo "missing: $f" >&2
+    fi
+done
+''',
+    u"Ruby": u'''class Account
+  attr_reader :balance
+
+  def initialize(balance = 0)
+    @balance = balance
+  end
+
+  def deposit(amount)
+    raise ArgumentError, "negative amount" if amount < 0
+    @balance += amount
+  end
+end
+''',
+    u"Perl": u'''#!/usr/bin/perl
+use strict;
+use warnings;
+
+my %count;
+while (my $line = <STDIN>) {
+    chomp $line;
+    $count{$_}++ for split /\\s+/, $line;
+}
+printf "%-20s %d\\n", $_, $count{$_} for sort keys %count;
+''',
+    u"CSS": u'''body {
+    font-family: Verdana, sans-serif;
+    margin: 0 auto;
+    max-width: 60em;
+}
+pre.code, .highlight {
+    background-color: #f7f9fa;
+    border: 1px dashed #8cacbb;
+}
+a:hover { color: #cc033c; }
+''',
+    u"INI": u'''[main]
+name = example
+debug = true
+
+[paths]
+; the data directory
+data = /var/lib/example
+logs = /var/log/example
+''',
+    u"Diff": u'''--- a/setup.py
++++ b/setup.py
+@@ -1,5 +1,6 @@
+ from distutils.core import setup
++import sys
+
+ setup(name="example",
+-      version="1.0",
++      version="1.1",
+       packages=["example"])
+''',
+}
+
+# the sizes of the huge blocks, in characters
+HUGE_SIZES = (250000, 1000000)
+
+class Config(object):
+    """
+    Configuration of the stub application
+    """
+    def __init__(self, values):
+        self.values = values
+    def get(self, section, option, default=None):
+        return self.values.get(option, default)
+    def getint(self, section, option, default=None):
+        value = self.values.get(option)
+        if value is None:
+            return default
+        return int(value)
+    def getboolean(self, section, option, default=None):
+        value = self.values.get(option)
+        if value is None:
+            return default
+        return unicode(value).lower() in (u"true", u"1", u"yes")
+    def set(self, section, option, value):
+        self.values[option] = value
+
+class App(object):
+    """
+    Stub of the WikidPad application
+    """
+    def __init__(self, values, configDir):
+        self.config = Config(values)
+        self.configDir = configDir
+    def getGlobalConfig(self):
+        return self.config
+    def getGlobalConfigSubDir(self):
+        return self.configDir
+    def getDefaultGlobalConfigDict(self):
+        return {}
+
+class WikiPage(object):
+    def __init__(self, text):
+        self.text = text
+    def getLiveText(self):
+        return self.text
+
+class WikiDocument(object):
+    """
+    Stub of the wiki, one page per block of the corpus
+    """
+    def __init__(self, pages):
+        self.pages = pages
+    def getWikiPage(self, word):
+        return WikiPage(self.pages[word])
+
+class Exporter(object):
+    """
+    Stub of an exporter, the file exports see the pages of the corpus
+    """
+    def __init__(self, wikiDocument=None, wordList=None):
+        self.wikiDocument = wikiDocument
+        self.wordList = wordList
+
+class InsertionToken(object):
+    """
+    Stub of PageAst.Insertion
+    """
+    def __init__(self, value, appendices=()):
+        self.key = u"pc"
+        self.value = value
+        self.appendices = appendices
+
+def buildCorpus(scale=1):
+    """
+    Return the corpus as a list of (name, insertion value)
+    @param scale: multiplier of the number of small blocks
+    """
+    corpus = []
+    variants = (
+        u"",
+        u"showLines=1",
+        u"showLines=1;startLine=10;hlLines=2,3,5",
+        u"bkg=",
+        u"showLines=0;hlLines=1;bkg=",
+    )
+    for i in range(scale):
+        for lang in sorted(SNIPPETS):
+            for j, variant in enumerate(variants):
+                # vary the code a bit so that the blocks are different
+                code = SNIPPETS[lang] + u"\n" * ((i * len(variants) + j) % 7)
+                options = u"lang=%s" % lang
+                if variant:
+                    options += u";" + variant
+                corpus.append((u"%s-%d-%d" % (lang, i, j), u"%s:::%s" % (code, options)))
+    for size in HUGE_SIZES:
+        for lang in (u"Python", u"C"):
+            snippet = SNIPPETS[lang]
+            code = snippet * (size // len(snippet) + 1)
+            corpus.append((u"%s-huge-%d" % (lang, size), u"%s:::lang=%s;showLines=1" % (code, lang)))
+    return corpus
+
+class WxStub(object):
+    """
+    Stand-in for the wxPython classes and objects used by the plugin
+    """
+    def __init__(self, *args, **kwargs):
+        pass
+    def __call__(self, *args, **kwargs):
+        return WxStub()
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return WxStub()
+
+class WxModule(types.ModuleType):
+    """
+    Stand-in for the wx module: the upper case names are constants (0),
+    the other capitalized names are classes which can be derived
+    """
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if name.isupper():
+            value = 0
+        elif name[:1].isupper():
+            value = type(name, (WxStub,), {})
+        else:
+            value = WxStub()
+        setattr(self, name, value)
+        return value
+
+def loadPlugin(path):
+    """
+    Import the plugin package from its directory, with the stand-in of wx
+    """
+    if not hasattr(__builtin__, "_"):
+        __builtin__._ = lambda text: text
+    if "wx" not in sys.modules:
+        sys.modules["wx"] = WxModule("wx")
+    return imp.load_module("prettyCode", None, path, ("", "", imp.PKG_DIRECTORY))
+
+def percentile(values, fraction):
+    """
+    Return the value at the given fraction of the sorted values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def getPeakMemory():
+    """
+    Return the peak memory of the process in KiB or None if unknown
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+def runExport(plugin, app, exportType, corpus):
+    """
+    Render the corpus once as a single export task
+    Return the list of (seconds, bytes, output bytes) of the calls to createContent()
+    """
+    if exportType in ("html_multi", "html_single"):
+        pages = dict((name, u"[:pc:///%s///]" % value) for name, value in corpus)
+        exporter = Exporter(WikiDocument(pages), [name for name, value in corpus])
+    else:
+        exporter = Exporter()
+    handler = plugin.InsertionHandler(app)
+    samples = []
+    handler.taskStart(exporter, exportType)
+    try:
+        for name, value in corpus:
+            insToken = InsertionToken(value)
+            start = time.time()
+            html = handler.createContent(exporter, exportType, insToken)
+            samples.append((time.time() - start, len(value.encode("utf-8")), len(html.encode("utf-8"))))
+    finally:
+        handler.taskEnd()
+    return samples
+
+def benchmark(plugin, app, exportTypes, corpus, repeat):
+    """
+    Run the benchmark and return the results as a dictionary
+    """
+    # load Pygments and the lexers out of the measures
+    runExport(plugin, app, "html_preview", corpus[:len(SNIPPETS)])
+    results = {}
+    for exportType in exportTypes:
+        samples = []
+        start = time.time()
+        for i in range(repeat):
+            # no lexing is reused from the previous task
+            plugin.incrementalHighlighter.clear()
+            plugin.tokenCache.clear()
+            samples.extend(runExport(plugin, app, exportType, corpus))
+        elapsed = time.time() - start
+        latencies = [seconds * 1000.0 for seconds, size, outputSize in samples]
+        total = sum(size for seconds, size, outputSize in samples)
+        results[exportType] = {
+            "blocks": len(samples),
+            "bytes": total,
+            "outputBytes": sum(outputSize for seconds, size, outputSize in samples),
+            "seconds": round(elapsed, 4),
+            "blocksPerSecond": round(len(samples) / elapsed, 2) if elapsed else None,
+            "megabytesPerSecond": round(total / 1048576.0 / elapsed, 3) if elapsed else None,
+            "latencyP50Ms": round(percentile(latencies, 0.5), 3),
+            "latencyP99Ms": round(percentile(latencies, 0.99), 3),
+            "latencyMaxMs": round(max(latencies), 3),
+        }
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of the prettyCode insertion rendering")
+    parser.add_argument("--types", default=",".join(EXPORT_TYPES),
+            help="comma separated list of the export types to run")
+    parser.add_argument("--scale", type=int, default=1,
+            help="multiplier of the number of small blocks")
+    parser.add_argument("--repeat", type=int, default=3,
+            help="number of export tasks run per export type")
+    parser.add_argument("--cache-size", type=int, default=0,
+            help="size of the render cache, 0 to measure the rendering only")
+    parser.add_argument("--time-limit", type=int, default=0,
+            help="time limit of a block in ms, 0 so that the huge blocks are always highlighted")
+    parser.add_argument("--parallel", action="store_true",
+            help="highlight the large blocks of the file exports in a process pool")
+    parser.add_argument("--compact-html", action="store_true",
+            help="merge the spans of the same style and compact the inline styles")
+    parser.add_argument("--in-process", action="store_true",
+            help="run all the export types in this process, the peak memory is then the one of the whole run")
+    parser.add_argument("--output", help="file to write the JSON results to, default: stdout")
+    args = parser.parse_args(argv)
+    exportTypes = [x.strip() for x in args.types.split(",") if x.strip()]
+
+    if len(exportTypes) > 1 and not args.in_process:
+        report = runIsolated(args, exportTypes)
+    else:
+        report = runInProcess(args, exportTypes)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print text
+
+def runIsolated(args, exportTypes):
+    """
+    Run each export type in its own process, so that the peak memory of
+    an export type is not the one of the previous ones
+    Return the merged report
+    """
+    argv = [sys.executable, os.path.abspath(__file__),
+        "--scale", str(args.scale), "--repeat", str(args.repeat),
+        "--cache-size", str(args.cache_size), "--time-limit", str(args.time_limit)]
+    if args.parallel:
+        argv.append("--parallel")
+    if args.compact_html:
+        argv.append("--compact-html")
+    report = None
+    for exportType in exportTypes:
+        fd, path = tempfile.mkstemp(prefix="prettyCode-bench-", suffix=".json")
+        os.close(fd)
+        try:
+            subprocess.check_call(argv + ["--types", exportType, "--output", path])
+            with open(path) as f:
+                typeReport = json.load(f)
+        finally:
+            os.remove(path)
+        if report is None:
+            report = typeReport
+        else:
+            report["results"].update(typeReport["results"])
+            report["peakMemoryKiB"] = max(report["peakMemoryKiB"], typeReport["peakMemoryKiB"])
+    return report
+
+def runInProcess(args, exportTypes):
+    """
+    Run the export types in this process
+    Return the report
+    """
+    plugin = loadPlugin(os.path.dirname(os.path.abspath(__file__)))
+    configDir = tempfile.mkdtemp(prefix="prettyCode-bench-")
+    try:
+        app = App({
+            plugin.OPTION_CACHESIZE: unicode(args.cache_size),
+            plugin.OPTION_CACHEPERSIST: u"False",
+            plugin.OPTION_TIMELIMIT: unicode(args.time_limit),
+            plugin.OPTION_PARALLEL: unicode(args.parallel),
+            plugin.OPTION_WARMUP: u"False",
+            plugin.OPTION_ASYNC: u"False",
+            plugin.OPTION_COMPACTHTML: unicode(args.compact_html),
+        }, configDir)
+        corpus = buildCorpus(args.scale)
+        results = benchmark(plugin, app, exportTypes, corpus, args.repeat)
+        plugin.shutdownHighlightPool()
+    finally:
+        shutil.rmtree(configDir, True)
+
+    peakMemory = getPeakMemory()
+    if len(exportTypes) == 1:
+        results[exportTypes[0]]["peakMemoryKiB"] = peakMemory
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "pygments": getattr(plugin.pygments, "__version__", None),
+        "corpusBlocks": len(corpus),
+        "repeat": args.repeat,
+        "cacheSize": args.cache_size,
+        "timeLimit": args.time_limit,
+        "parallel": args.parallel,
+        "compactHtml": args.compact_html,
+        "peakMemoryKiB": peakMemory,
+        "timings": dict((name, round(seconds, 4)) for name, seconds in plugin.timings.items()),
+        "results": results,
+    }
+
+if __name__ == "__main__":
+    main()